@@ -0,0 +1,241 @@
+# Python
+import codecs
+import json
+from typing import Any, AsyncIterator, List, Tuple, Type
+
+# Pydantic
+from pydantic import BaseModel, ValidationError
+
+# FastAPI
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import StreamingResponse
+
+# Parsers
+
+# Characters an unfinished array item or NDJSON line can take before it is
+# refused, otherwise a malformed body would be buffered until its end
+MAX_ITEM_SIZE = 1024 * 1024
+
+
+async def _decode(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+async def iter_ndjson(texts: AsyncIterator[str],
+                      max_item_size: int = MAX_ITEM_SIZE) -> AsyncIterator[Tuple[int, Any]]:
+    """Yield (line number, record) for every non empty line
+
+    A line that is not valid JSON yields its JSONDecodeError instead of a
+    record. A line longer than max_item_size yields an error as soon as it
+    goes over, and the rest of it is skipped until the next newline.
+    """
+    parts: List[str] = []
+    size = 0
+    number = 0
+    skipping = False
+    async for text in texts:
+        # Only the new text is searched for newlines
+        *ended, rest = text.split("\n")
+        for piece in ended:
+            if skipping:
+                skipping = False
+                continue
+            number += 1
+            parts.append(piece)
+            line = "".join(parts)
+            parts, size = [], 0
+            if len(line) > max_item_size:
+                yield number, json.JSONDecodeError(
+                    f"Line longer than {max_item_size} characters", "", 0)
+            elif line.strip():
+                try:
+                    yield number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield number, e
+        if not skipping:
+            parts.append(rest)
+            size += len(rest)
+            if size > max_item_size:
+                number += 1
+                yield number, json.JSONDecodeError(
+                    f"Line longer than {max_item_size} characters", "", 0)
+                parts, size, skipping = [], 0, True
+    line = "".join(parts)
+    if line.strip():
+        number += 1
+        try:
+            yield number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield number, e
+
+
+async def iter_json_array(texts: AsyncIterator[str],
+                          max_item_size: int = MAX_ITEM_SIZE) -> AsyncIterator[Tuple[int, Any]]:
+    """Yield (item number, record) for every item of a JSON array
+
+    Items are decoded as soon as they are complete. The array can't be
+    resumed after invalid JSON, so the error is yielded and parsing stops,
+    an item still incomplete after max_item_size characters is an error.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    number = 0
+    # "[" before the array, "value" or "]" inside it, "," or "]" after an item
+    expected = "["
+    finished = False
+    while True:
+        buffer = buffer.lstrip()
+        if buffer:
+            if buffer[0] == "]" and expected in ("value]", ",]"):
+                return
+            if expected in ("[", ",]"):
+                if buffer[0] != expected[0]:
+                    yield number + 1, json.JSONDecodeError(
+                        f"Expecting '{expected[0]}'", buffer, 0)
+                    return
+                buffer = buffer[1:]
+                expected = "value]" if expected == "[" else "value"
+                continue
+            try:
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError as e:
+                if finished or len(buffer) > max_item_size:
+                    # Past the limit the item is invalid, not incomplete
+                    yield number + 1, e
+                    return
+            else:
+                # A value ending with the buffer may still continue (numbers)
+                if end < len(buffer) or finished:
+                    number += 1
+                    buffer, expected = buffer[end:], ",]"
+                    yield number, record
+                    continue
+        if finished:
+            yield number + 1, json.JSONDecodeError(
+                "Unexpected end of the array", buffer, 0)
+            return
+        if len(buffer) > max_item_size:
+            yield number + 1, json.JSONDecodeError(
+                f"Item bigger than {max_item_size} characters", buffer, 0)
+            return
+        try:
+            buffer += await texts.__anext__()
+        except StopAsyncIteration:
+            finished = True
+
+
+async def iter_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any]]:
+    """Yield the records of a NDJSON or JSON array body
+
+    The format is picked from the first character of the body.
+    """
+    texts = _decode(chunks)
+    first = ""
+    async for text in texts:
+        first += text
+        if first.strip():
+            break
+
+    async def rest():
+        yield first
+        async for text in texts:
+            yield text
+
+    parser = iter_json_array if first.lstrip().startswith("[") else iter_ndjson
+    async for item in parser(rest()):
+        yield item
+
+# Import
+
+
+async def import_records(chunks: AsyncIterator[bytes], model_class: Type[BaseModel],
+                         prepare, save_many, batch_size: int) -> AsyncIterator[bytes]:
+    """Validate records against a model and save the valid ones in batches
+
+    Results are kept until their batch is saved, so every report line
+    means the row is committed, and never more than batch_size lines
+    are held in memory.
+
+    Args:
+        chunks: the request body.
+        model_class (Type[BaseModel]): the model every record must match.
+        prepare: coroutine turning a list of models into the rows to save,
+            called once per batch (the password hashing).
+        save_many: coroutine saving a list of rows in one transaction,
+            raising ValueError when the store refuses them.
+        batch_size (int): lines per transaction.
+
+    Returns:
+        NDJSON lines with the result of every record and a final summary
+    """
+    created = invalid = 0
+    valid: List[Tuple[dict, BaseModel]] = []
+    reports: List[dict] = []
+
+    async def save(rows: List[Tuple[dict, Any]]):
+        nonlocal created, invalid
+        try:
+            await save_many([row for _, row in rows])
+        except ValueError as e:
+            if len(rows) == 1:
+                created -= 1
+                invalid += 1
+                rows[0][0].update(status="invalid", errors=[
+                    {"loc": ["body"], "msg": str(e), "type": "value_error"}])
+                return
+            # The store refused the batch, split it to find the rows it
+            # refuses in a few transactions instead of one per row
+            middle = len(rows) // 2
+            await save(rows[:middle])
+            await save(rows[middle:])
+
+    async def flush():
+        if valid:
+            prepared = await prepare([model for _, model in valid])
+            await save([(report, row) for (report, _), row in zip(valid, prepared)])
+        lines = "".join(json.dumps(report) + "\n" for report in reports)
+        valid.clear()
+        reports.clear()
+        return lines.encode()
+
+    async for number, record in iter_records(chunks):
+        if isinstance(record, json.JSONDecodeError):
+            invalid += 1
+            reports.append({"line": number, "status": "invalid", "errors": [
+                {"loc": ["body"], "msg": record.msg, "type": "value_error.jsondecode"}]})
+        else:
+            try:
+                model = model_class.parse_obj(record)
+            except ValidationError as e:
+                invalid += 1
+                reports.append({"line": number, "status": "invalid",
+                                "errors": jsonable_encoder(e.errors())})
+            else:
+                created += 1
+                reports.append({"line": number, "status": "created"})
+                valid.append((reports[-1], model))
+        if len(reports) >= batch_size:
+            yield await flush()
+    yield await flush()
+    yield (json.dumps({"created": created, "invalid": invalid}) + "\n").encode()
+
+
+class RequestStreamingResponse(StreamingResponse):
+    """StreamingResponse for content that still reads the request body
+
+    StreamingResponse listens to receive() for a disconnect while it
+    streams, which would steal the body chunks from the content. Here
+    the content is the only reader and a disconnect ends the body stream.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
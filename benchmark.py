@@ -0,0 +1,391 @@
+"""Benchmark every path operation of main.py
+
+The app is driven in process over ASGI, without a server or sockets, so
+the numbers only measure FastAPI, the validation and the handlers. The
+response cache is off unless CACHE_TTL is set, so the cached routes are
+measured instead of the replay of their first response.
+
+Usage:
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.1
+"""
+
+# Python
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlencode
+
+os.environ.setdefault("IMAGE_STORE_DIR", tempfile.mkdtemp(prefix="benchmark-"))
+os.environ.setdefault("MAX_IMAGE_SIZE", str(64 * 1024 * 1024))
+# person_batch measures the import pipeline, a full cost scrypt would make
+# a 1 MiB import take minutes. person_new and login measure the KDF
+os.environ.setdefault("KDF_IMPORT_COST", "2")
+os.environ.setdefault("CACHE_TTL", "0")
+
+# FastAPI
+import fastapi
+
+import main
+
+PERSON = {
+    "first_name": "facundo",
+    "last_name": "cabrera cabrales",
+    "age": 22,
+    "hair_color": "black",
+    "is_married": False,
+    "password": "12345678"
+}
+
+# Only the signature is checked by the store
+PNG = b"\x89PNG\r\n\x1a\n"
+
+# ASGI client
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes = b""
+    query: str = ""
+
+
+class Result(NamedTuple):
+    status: int
+    body: bytes
+    headers: List[Tuple[bytes, bytes]]
+
+
+async def call(app, request: Request, chunk_size: int = 64 * 1024) -> Result:
+    """Send a request to an ASGI app and collect the response"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": request.method,
+        "scheme": "http",
+        "path": request.path,
+        "raw_path": request.path.encode(),
+        "query_string": request.query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"benchmark")] + request.headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+    }
+    chunks = [request.body[i:i + chunk_size]
+              for i in range(0, len(request.body), chunk_size)] or [b""]
+    response = {"status": 0, "body": [], "headers": []}
+    finished = asyncio.Event()
+
+    async def receive():
+        if chunks:
+            chunk = chunks.pop(0)
+            return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+    finished.set()
+    return Result(response["status"], b"".join(response["body"]), response["headers"])
+
+# Scenarios
+
+
+def json_request(method: str, path: str, data,
+                 headers: Optional[List[Tuple[bytes, bytes]]] = None) -> Request:
+    body = json.dumps(data).encode()
+    return Request(method, path, [(b"content-type", b"application/json"),
+                                  (b"content-length", str(len(body)).encode())]
+                   + (headers or []), body)
+
+
+def session_headers() -> List[Tuple[bytes, bytes]]:
+    return [(b"authorization", b"Bearer " + SESSION["token"])]
+
+
+def form_request(path: str, fields: Dict[str, str],
+                 headers: Optional[List[Tuple[bytes, bytes]]] = None) -> Request:
+    body = urlencode(fields).encode()
+    return Request("POST", path, [
+        (b"content-type", b"application/x-www-form-urlencoded"),
+        (b"content-length", str(len(body)).encode())] + (headers or []), body)
+
+
+def multipart_request(path: str, field: str, filename: str,
+                      content_type: str, content: bytes) -> Request:
+    boundary = "benchmark-boundary"
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return Request("POST", path, [
+        (b"content-type", f"multipart/form-data; boundary={boundary}".encode()),
+        (b"content-length", str(len(body)).encode())], body)
+
+
+def contact_request(size: int) -> Request:
+    return form_request("/contact", {
+        "first_name": "facundo",
+        "last_name": "cabrera",
+        "email": "facundo@example.com",
+        "message": "x" * max(size, 20),
+    }, headers=[(b"user-agent", b"benchmark"), (b"cookie", b"ads=summer")])
+
+
+def batch_request(size: int) -> Request:
+    line = json.dumps(PERSON) + "\n"
+    body = (line * max(size // len(line), 1)).encode()
+    return Request("POST", "/person/batch", [
+        (b"content-type", b"application/x-ndjson"),
+        (b"content-length", str(len(body)).encode())], body)
+
+
+class Scenario(NamedTuple):
+    name: str
+    build: Callable[[int, int], Request]
+    sized: bool = False
+    # Levels above it are run at it, 0 is no limit
+    max_concurrency: int = 0
+
+
+# Past KDF_WORKERS + KDF_QUEUE password hashing answers 503 by design, so
+# the scenarios using it would mostly measure the rejections
+KDF_LIMIT = main.passwords.limit
+
+
+SCENARIOS = [
+    Scenario("home", lambda i, size: Request("GET", "/", [])),
+    Scenario("metrics", lambda i, size: Request("GET", "/metrics", [])),
+    Scenario("person_new", lambda i, size: json_request(
+        "POST", "/person/new", PERSON), max_concurrency=KDF_LIMIT),
+    Scenario("person_batch", lambda i, size: batch_request(size), sized=True),
+    Scenario("person_detail_query", lambda i, size: Request(
+        "GET", "/person/detail", [], query=f"name=kevin&age={i % 100}")),
+    Scenario("person_detail_id", lambda i, size: Request(
+        "GET", f"/person/detail/{i % 100 + 1}", [])),
+    Scenario("persons_list", lambda i, size: Request(
+        "GET", "/persons", [], query=f"hair_color=black&age_min=18&cursor={i % 50}")),
+    Scenario("persons_export", lambda i, size: Request(
+        "GET", "/persons/export", [], query="format=csv")),
+    # Only the person of the session can be updated, with the same password
+    # so the session stays valid
+    Scenario("person_update", lambda i, size: json_request(
+        "PUT", SESSION["person"], {**PERSON, "username": "valeryok", "age": i % 100 + 1},
+        headers=session_headers()), max_concurrency=KDF_LIMIT),
+    Scenario("login", lambda i, size: form_request(
+        "/login", {"username": "valeryok", "password": "12345678"}),
+        max_concurrency=KDF_LIMIT),
+    Scenario("show_session", lambda i, size: Request(
+        "GET", "/login", session_headers())),
+    Scenario("contact", lambda i, size: contact_request(size), sized=True),
+    Scenario("post_image", lambda i, size: multipart_request(
+        "/post-image", "image", "image.png", "image/png",
+        PNG + i.to_bytes(8, "big") + b"\0" * max(size - 16, 0)), sized=True),
+    Scenario("show_image", lambda i, size: Request(
+        "GET", "/post-image/" + IMAGES[i % len(IMAGES)], [])),
+]
+
+IMAGES: List[str] = []
+
+SESSION: Dict[str, bytes] = {}
+
+
+async def setup(app) -> None:
+    """Create the persons and images read by the scenarios"""
+    for _ in range(100):
+        await call(app, json_request("POST", "/person/new", PERSON))
+    result = await call(app, json_request(
+        "POST", "/person/new", {**PERSON, "username": "valeryok"}))
+    person = dict(result.headers)[b"location"].decode()
+    SESSION["person"] = person.replace("/detail", "")
+    for i in range(10):
+        result = await call(app, multipart_request(
+            "/post-image", "image", "image.png", "image/png",
+            PNG + bytes([i]) * 32 * 1024))
+        IMAGES.append(json.loads(result.body)["Url"].rsplit("/", 1)[1])
+    result = await call(app, form_request(
+        "/login", {"username": "valeryok", "password": "12345678"}))
+    cookie = dict(result.headers)[b"set-cookie"]
+    SESSION["token"] = cookie.split(b";", 1)[0].split(b"=", 1)[1]
+
+# Runner
+
+
+def percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    index = min(int(round(percent / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+async def run_level(app, scenario: Scenario, size: int,
+                    concurrency: int, requests: int) -> Tuple[List[float], float, List[int]]:
+    latencies: List[float] = []
+    statuses: List[int] = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            request = scenario.build(i, size)
+            started = time.perf_counter()
+            result = await call(app, request)
+            latencies.append(time.perf_counter() - started)
+            statuses.append(result.status)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started, statuses
+
+
+async def measure(app, scenario: Scenario, size: int, concurrency: int,
+                  requests: int, memory: bool) -> dict:
+    latencies, elapsed, statuses = await run_level(
+        app, scenario, size, concurrency, requests)
+    result = {
+        "requests": requests,
+        "errors": sum(status >= 400 for status in statuses),
+        "throughput": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+    }
+    if memory:
+        # tracemalloc slows everything down, so the peak is a separate run
+        tracemalloc.start()
+        await run_level(app, scenario, size, concurrency,
+                        max(min(requests, 50), concurrency))
+        result["peak_memory_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return result
+
+
+async def run(args) -> dict:
+    app = main.app
+    await app.router.startup()
+    try:
+        await setup(app)
+        results = {}
+        for scenario in SCENARIOS:
+            if args.only and scenario.name not in args.only:
+                continue
+            levels = sorted({min(level, scenario.max_concurrency or level)
+                             for level in args.concurrency})
+            for size in args.sizes if scenario.sized else [0]:
+                for concurrency in levels:
+                    key = f"{scenario.name} size={size} c={concurrency}"
+                    results[key] = await measure(
+                        app, scenario, size, concurrency, args.requests, not args.no_memory)
+                    print(format_line(key, results[key]), flush=True)
+    finally:
+        await app.router.shutdown()
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "fastapi": fastapi.__version__,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "sizes": args.sizes,
+        },
+        "results": results,
+    }
+
+# Report
+
+
+def format_line(key: str, result: dict) -> str:
+    memory = result.get("peak_memory_kb")
+    return (f"{key:<40} {result['throughput']:>9.1f} req/s"
+            f"  p50 {result['p50_ms']:>7.2f}ms  p95 {result['p95_ms']:>7.2f}ms"
+            f"  p99 {result['p99_ms']:>7.2f}ms"
+            + (f"  peak {memory:>9.1f}KiB" if memory is not None else "")
+            + (f"  errors {result['errors']}" if result["errors"] else ""))
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """Regressions bigger than threshold between two benchmark files
+
+    Args:
+        baseline (dict): the saved benchmark.
+        current (dict): the benchmark just run.
+        threshold (float): allowed change, 0.1 is 10%.
+
+    Returns:
+        A line for every regression, and for any increase of the errors
+    """
+    regressions = []
+    for key, result in current["results"].items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        if result["errors"] > base.get("errors", 0):
+            regressions.append(
+                f"{key}: errors {base.get('errors', 0)} -> {result['errors']}")
+        checks = [("throughput", base["throughput"] / result["throughput"] - 1)]
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "peak_memory_kb"):
+            if metric in base and metric in result and base[metric]:
+                checks.append((metric, result[metric] / base[metric] - 1))
+        for metric, change in checks:
+            if change > threshold:
+                regressions.append(
+                    f"{key}: {metric} {base[metric]:.2f} -> {result[metric]:.2f}"
+                    f" ({change:+.0%} worse)")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per scenario and concurrency level")
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in v.split(",")],
+                        default=[1, 10, 50], help="comma separated levels")
+    parser.add_argument("--sizes", type=lambda v: [int(s) for s in v.split(",")],
+                        default=[1024, 100 * 1024, 1024 * 1024],
+                        help="comma separated payload sizes in bytes")
+    parser.add_argument("--only", nargs="*", help="scenario names to run")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory run")
+    parser.add_argument("--output", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed regression, 0.1 is 10%%")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None) -> int:
+    args = parse_args(argv)
+    current = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(current, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), current, args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+        print(f"No regression bigger than {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
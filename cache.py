@@ -0,0 +1,237 @@
+# Python
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+# SQLAlchemy
+from sqlalchemy import (Column, Float, Integer, LargeBinary, MetaData, String,
+                        Table, Text, delete, insert, select)
+from sqlalchemy.exc import IntegrityError
+
+# Storage
+from storage import create_engine
+
+# Starlette
+from starlette.datastructures import Headers
+
+# Backends
+
+
+class CachedResponse(NamedTuple):
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    etag: str
+
+
+class MemoryCache:
+    """LRU cache with a TTL kept in the memory of the worker
+
+    Args:
+        max_entries (int): responses kept before the least used is evicted.
+        ttl (float): seconds a response is kept.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, CachedResponse]]" = OrderedDict()
+        self._keys: Dict[str, Set[str]] = {}
+
+    async def connect(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    async def set(self, path: str, key: str, response: CachedResponse) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        self._keys.setdefault(path, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    async def invalidate(self, path: str) -> None:
+        for key in self._keys.pop(path, ()):
+            self._entries.pop(key, None)
+
+    def _remove(self, key: str) -> None:
+        self._entries.pop(key, None)
+        path = key.split("?", 1)[0]
+        keys = self._keys.get(path)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[path]
+
+
+metadata = MetaData()
+
+cache_table = Table(
+    "response_cache",
+    metadata,
+    Column("key", String(2048), primary_key=True),
+    Column("path", String(2048), nullable=False, index=True),
+    Column("status", Integer, nullable=False),
+    Column("headers", Text, nullable=False),
+    Column("body", LargeBinary, nullable=False),
+    Column("etag", String(80), nullable=False),
+    Column("expires_at", Float, nullable=False, index=True),
+)
+
+
+class SQLCache:
+    """Cache shared by every worker through a database table
+
+    A sqlite file is enough when all the workers run on the same host.
+    Entries only expire by TTL, there is no LRU limit.
+
+    Args:
+        url (str): async database url, e.g. "sqlite+aiosqlite:///cache.db".
+        ttl (float): seconds a response is kept.
+    """
+
+    def __init__(self, url: str, ttl: float = 60):
+        self.ttl = ttl
+        self.engine = create_engine(url)
+
+    async def connect(self) -> None:
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+
+    async def close(self) -> None:
+        await self.engine.dispose()
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(cache_table).where(cache_table.c.key == key,
+                                          cache_table.c.expires_at > time.time()))
+            row = result.mappings().first()
+        if row is None:
+            return None
+        headers = [(name.encode("latin-1"), value.encode("latin-1"))
+                   for name, value in json.loads(row["headers"])]
+        return CachedResponse(row["status"], headers, row["body"], row["etag"])
+
+    async def set(self, path: str, key: str, response: CachedResponse) -> None:
+        now = time.time()
+        headers = json.dumps([(name.decode("latin-1"), value.decode("latin-1"))
+                              for name, value in response.headers])
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(delete(cache_table).where(
+                    (cache_table.c.key == key) | (cache_table.c.expires_at <= now)))
+                await conn.execute(insert(cache_table).values(
+                    key=key, path=path, status=response.status, headers=headers,
+                    body=response.body, etag=response.etag, expires_at=now + self.ttl))
+        except IntegrityError:
+            # Another worker stored the same response first
+            pass
+
+    async def invalidate(self, path: str) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                delete(cache_table).where(cache_table.c.path == path))
+
+
+def create_cache(url: Optional[str] = None, max_entries: int = 1024, ttl: float = 60):
+    """Build the response cache for a database url
+
+    Args:
+        url (Optional[str]): database url of the shared cache, the memory cache is used when empty.
+        max_entries (int): responses kept by the memory cache.
+        ttl (float): seconds a response is kept.
+
+    Returns:
+        The cache backend
+    """
+    if not url:
+        return MemoryCache(max_entries=max_entries, ttl=ttl)
+    return SQLCache(url, ttl=ttl)
+
+# Middleware
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+class ResponseCacheMiddleware:
+    """Cache the 200 responses of GET routes and answer conditional GETs
+
+    Cached responses are replayed, or answered with a 304 when the
+    If-None-Match header has their ETag, before the request reaches the
+    route, so neither the validation nor the handler run.
+
+    Args:
+        app: the ASGI app to wrap.
+        cache: the cache backend.
+        paths (tuple): regular expressions of the cached paths.
+    """
+
+    def __init__(self, app, cache, paths: tuple):
+        self.app = app
+        self.cache = cache
+        self.paths = [re.compile(path) for path in paths]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" \
+                or not any(path.fullmatch(scope["path"]) for path in self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        query = scope["query_string"].decode("latin-1")
+        key = f"{path}?{'&'.join(sorted(query.split('&')))}" if query else path
+        if_none_match = Headers(scope=scope).get("if-none-match")
+
+        cached = await self.cache.get(key)
+        if cached is None:
+            start = {}
+            body = []
+
+            async def capture(message):
+                if message["type"] == "http.response.start":
+                    start.update(message)
+                elif message["type"] == "http.response.body":
+                    body.append(message.get("body", b""))
+
+            await self.app(scope, receive, capture)
+            content = b"".join(body)
+            etag = f'"{hashlib.sha256(content).hexdigest()}"'
+            headers = [(name, value) for name, value in start["headers"]
+                       if name.lower() != b"etag"]
+            headers.append((b"etag", etag.encode("latin-1")))
+            cached = CachedResponse(start["status"], headers, content, etag)
+            if cached.status == 200:
+                await self.cache.set(path, key, cached)
+
+        if cached.status == 200 and etag_matches(if_none_match, cached.etag):
+            await send({
+                "type": "http.response.start",
+                "status": 304,
+                "headers": [(b"etag", cached.etag.encode("latin-1"))]
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({"type": "http.response.start",
+                    "status": cached.status, "headers": cached.headers})
+        await send({"type": "http.response.body", "body": cached.body})
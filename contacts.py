@@ -0,0 +1,214 @@
+# Python
+import asyncio
+import logging
+import smtplib
+from email.message import EmailMessage
+from typing import List, Optional
+
+# SQLAlchemy
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError
+
+# FastAPI
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# Errors worth trying again, any other one means the store refuses the data
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, DisconnectionError,
+                    OSError, asyncio.TimeoutError)
+
+# Notifiers
+
+
+class Notifier:
+    """Told about every batch of contact messages once it is saved"""
+
+    async def send(self, messages: List[dict]) -> None:
+        raise NotImplementedError
+
+
+class LogNotifier(Notifier):
+
+    async def send(self, messages: List[dict]) -> None:
+        for message in messages:
+            logger.info("Contact message from %s", message["email"])
+
+
+class SMTPNotifier(Notifier):
+    """Send one email per batch through an SMTP server
+
+    Args:
+        host (str): SMTP host.
+        port (int): SMTP port.
+        sender (str): From address.
+        to (str): address that gets the contact messages.
+    """
+
+    def __init__(self, host: str, port: int, sender: str, to: str):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.to = to
+
+    def _send(self, messages: List[dict]) -> None:
+        email = EmailMessage()
+        email["Subject"] = f"{len(messages)} new contact messages"
+        email["From"] = self.sender
+        email["To"] = self.to
+        email.set_content("\n\n".join(
+            f"{message['first_name']} {message['last_name']} <{message['email']}>\n"
+            f"{message['message']}"
+            for message in messages))
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            smtp.send_message(email)
+
+    async def send(self, messages: List[dict]) -> None:
+        await run_in_threadpool(self._send, messages)
+
+# Queue
+
+
+class ContactQueue:
+    """Contact messages saved and notified in batches by background workers
+
+    The path operation only puts the message in a bounded queue. When it
+    is full, or the app is stopping, new messages get a 503 so nothing
+    accepted is dropped. Saving a batch is retried with a growing delay
+    until it works or the shutdown drain times out, only a message the
+    database refuses (an integrity or data error) is logged and dropped.
+    The notification is retried a few times since the messages are
+    already stored.
+
+    Args:
+        store: the store with save_contacts.
+        notifier (Notifier): told about every saved batch.
+        maxsize (int): messages waiting at most.
+        batch_size (int): messages handled together.
+        workers (int): background workers.
+        linger (float): seconds a worker waits to fill a batch.
+        retries (int): attempts to notify every batch.
+        max_delay (float): longest wait in seconds between two attempts.
+    """
+
+    def __init__(self, store, notifier: Notifier, maxsize: int = 1000,
+                 batch_size: int = 50, workers: int = 2, linger: float = 0.05,
+                 retries: int = 3, max_delay: float = 10):
+        self.store = store
+        self.notifier = notifier
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.workers = workers
+        self.linger = linger
+        self.retries = retries
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._accepting = False
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._accepting = True
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Stop accepting messages and wait until the queue is drained"""
+        self._accepting = False
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error("The contact queue was not drained before the shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if not self._queue.empty():
+            logger.error("Lost %s queued contact messages", self._queue.qsize())
+
+    def submit(self, message: dict) -> None:
+        """Queue a message, a 503 when the queue can't take it"""
+        if not self._accepting:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Contact messages are not accepted right now"
+            )
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many contact messages, try again later",
+                headers={"Retry-After": "1"}
+            )
+
+    async def _work(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.linger
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._handle(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _delay(self, attempt: int) -> float:
+        return min(0.1 * 2 ** attempt, self.max_delay)
+
+    async def _save(self, batch: List[dict]) -> List[dict]:
+        """Save a batch, the messages saved
+
+        Connection errors are retried until the batch is saved. A batch
+        the database refuses is split to find the messages it refuses,
+        which are logged and dropped so they can't block a worker.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await self.store.save_contacts(batch)
+                return batch
+            except TRANSIENT_ERRORS:
+                logger.exception("Saving a contact batch failed, attempt %s", attempt)
+            except Exception:
+                if len(batch) == 1:
+                    logger.exception("Dropped a contact message the store refuses: %r",
+                                     batch[0])
+                    return []
+                middle = len(batch) // 2
+                return await self._save(batch[:middle]) + await self._save(batch[middle:])
+            await asyncio.sleep(self._delay(attempt))
+
+    async def _handle(self, batch: List[dict]) -> None:
+        try:
+            batch = await self._save(batch)
+        except asyncio.CancelledError:
+            # Only when the shutdown drain timed out
+            logger.error("Lost %s contact messages: %r", len(batch), batch)
+            raise
+        if not batch:
+            return
+        for attempt in range(1, self.retries + 1):
+            try:
+                await self.notifier.send(batch)
+                return
+            except Exception:
+                logger.exception("Contact batch notification failed, attempt %s of %s",
+                                 attempt, self.retries)
+            if attempt < self.retries:
+                await asyncio.sleep(self._delay(attempt))
@@ -0,0 +1,383 @@
+# Python
+import hashlib
+import os
+import re
+import tempfile
+from typing import NamedTuple, Optional, Tuple
+
+# FastAPI
+from fastapi import HTTPException, status
+
+# Starlette
+from anyio import to_thread
+from multipart.multipart import MultipartParser, parse_options_header
+from multipart.exceptions import MultipartParseError
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+CHUNK_SIZE = 64 * 1024
+
+IMAGE_NAME = re.compile(r"^[0-9a-f]{64}$")
+
+# Upload size limit
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+class MaxBodySizeMiddleware:
+    """Reject request bodies bigger than max_size with a 413
+
+    The Content-Length header is checked before anything is read, and the
+    body is counted while it streams so chunked uploads stop as soon as
+    they go over the limit instead of being spooled completely.
+
+    Args:
+        app: the ASGI app to wrap.
+        max_size (int): max body size in bytes.
+        paths (tuple): request paths the limit applies to.
+    """
+
+    def __init__(self, app, max_size: int, paths: tuple):
+        self.app = app
+        self.max_size = max_size
+        self.paths = paths
+
+    def too_large(self):
+        return JSONResponse(
+            {"detail": f"The body is bigger than {self.max_size} bytes"},
+            status_code=413
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() \
+                and int(content_length) > self.max_size:
+            await self.too_large()(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_size:
+                exceeded = True
+                raise PayloadTooLarge()
+            return message
+
+        async def guarded_send(message):
+            # Whatever the app answers after the limit is replaced by the 413
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except PayloadTooLarge:
+            pass
+        if exceeded:
+            await self.too_large()(scope, receive, send)
+
+# Multipart uploads
+
+
+class MultipartFile:
+    """The file of one field of a multipart body, read while it streams
+
+    Starlette spools every file of a form to a temporary file before the
+    handler runs, so an upload going to the store would be written twice.
+    This parses the body with python-multipart as it arrives instead, the
+    chunks of the file are handed over without being written anywhere.
+
+    Args:
+        content_type (str): the Content-Type header of the request.
+        chunks: the body, as the async iterator of Request.stream().
+        field (str): name of the file field.
+    """
+
+    def __init__(self, content_type: str, chunks, field: str):
+        self.content_type = content_type
+        self.chunks = chunks
+        self.field = field.encode()
+        self.filename: Optional[str] = None
+        self._events = self._parse()
+
+    def _boundary(self) -> bytes:
+        kind, options = parse_options_header(self.content_type)
+        boundary = options.get(b"boundary")
+        if kind != b"multipart/form-data" or not boundary:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="The body must be multipart/form-data"
+            )
+        return boundary
+
+    async def _parse(self):
+        """Yield ("file", filename), ("data", chunk)... and ("end", None)"""
+        events = []
+        header = {"field": b"", "value": b""}
+        headers = {}
+        target = False
+
+        def on_part_begin():
+            nonlocal target
+            headers.clear()
+            target = False
+
+        def on_header_field(data, start, end):
+            header["field"] += data[start:end]
+
+        def on_header_value(data, start, end):
+            header["value"] += data[start:end]
+
+        def on_header_end():
+            headers[header["field"].lower()] = header["value"]
+            header.update(field=b"", value=b"")
+
+        def on_headers_finished():
+            nonlocal target
+            _, options = parse_options_header(headers.get(b"content-disposition", b""))
+            if options.get(b"name") == self.field and b"filename" in options:
+                target = True
+                events.append(("file", options[b"filename"].decode("utf-8", "replace")))
+
+        def on_part_data(data, start, end):
+            if target:
+                events.append(("data", bytes(data[start:end])))
+
+        def on_part_end():
+            nonlocal target
+            if target:
+                events.append(("end", None))
+            target = False
+
+        parser = MultipartParser(self._boundary(), {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        })
+        try:
+            async for chunk in self.chunks:
+                parser.write(chunk)
+                for event in events:
+                    yield event
+                events.clear()
+            parser.finalize()
+        except MultipartParseError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="The multipart body is not valid"
+            )
+        for event in events:
+            yield event
+
+    async def open(self) -> None:
+        """Read the body until the file field starts"""
+        async for kind, value in self._events:
+            if kind == "file":
+                self.filename = value
+                return
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"The {self.field.decode()} file is missing"
+        )
+
+    async def __aiter__(self):
+        """The data of the file, call open() first"""
+        async for kind, value in self._events:
+            if kind == "end":
+                return
+            if kind == "data" and value:
+                yield value
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The multipart body ended in the middle of the file"
+        )
+
+# Content addressed store
+
+# Magic bytes of the images that are accepted, anything else is a 415 so
+# an upload can never be served back as html or script
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+SNIFF_SIZE = 12
+
+
+def sniff_image(head: bytes) -> Optional[str]:
+    """Media type of an image from its first bytes, None when not allowed"""
+    for signature, kind in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class StoredImage(NamedTuple):
+    name: str
+    size: int
+    media_type: str
+    created: bool
+
+
+class ImageStore:
+    """Images saved on disk under the sha256 of their content
+
+    The name is only the hash, so the same bytes are written once whatever
+    the client says they are. The media type is taken from the magic bytes
+    and saved next to the image in "<name>.type".
+
+    Args:
+        root (str): directory where the images are saved.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, name: str) -> Optional[str]:
+        """Path of a stored image, None when the name is not valid"""
+        if not IMAGE_NAME.match(name):
+            return None
+        return os.path.join(self.root, name[:2], name)
+
+    async def save(self, upload: MultipartFile) -> StoredImage:
+        """Stream an uploaded file to the store
+
+        The hash and the size are computed while the chunks arrive, so the
+        image never sits completely in memory.
+
+        Args:
+            upload (MultipartFile): the opened file field.
+
+        Raises:
+            HTTPException: 415 when the content is not an allowed image
+
+        Returns:
+            The name, size in bytes, media type and whether the image was new
+        """
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+        kind = None
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                async for chunk in upload:
+                    if kind is None:
+                        head += chunk
+                        if len(head) < SNIFF_SIZE:
+                            continue
+                        kind = self._check(head)
+                        chunk, head = head, b""
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await to_thread.run_sync(tmp.write, chunk)
+                if kind is None:
+                    # Smaller than SNIFF_SIZE
+                    kind = self._check(head)
+                    digest.update(head)
+                    size += len(head)
+                    await to_thread.run_sync(tmp.write, head)
+            name = digest.hexdigest()
+            created = await to_thread.run_sync(self._publish, tmp_path, name, kind)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return StoredImage(name=name, size=size, media_type=kind, created=created)
+
+    @staticmethod
+    def _check(head: bytes) -> str:
+        kind = sniff_image(head)
+        if kind is None:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail="Only png, jpeg, gif and webp images are accepted"
+            )
+        return kind
+
+    def _publish(self, tmp_path: str, name: str, kind: str) -> bool:
+        path = self.path(name)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The type goes first, an image on disk always has one
+        with open(path + ".type", "w") as type_file:
+            type_file.write(kind)
+        os.replace(tmp_path, path)
+        return True
+
+    def media_type(self, name: str) -> str:
+        """The checked media type of a stored image, blocking"""
+        with open(self.path(name) + ".type") as type_file:
+            return type_file.read()
+
+# Ranges
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "bytes=start-end" Range header
+
+    An invalid header, or one with several ranges, is ignored as RFC 9110
+    asks, so the whole file is sent.
+
+    Args:
+        header (str): the Range header.
+        size (int): size of the file.
+
+    Raises:
+        RangeNotSatisfiable: a valid single range outside of the file
+
+    Returns:
+        The first and last byte of the range, None when it is ignored
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start and end and int(end) < int(start):
+        return None
+    if not start:
+        # bytes=-500 are the last 500 bytes
+        if int(end) == 0:
+            raise RangeNotSatisfiable()
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+async def read_range(path: str, start: int, end: int):
+    """Yield the bytes between start and end, both included"""
+    with open(path, "rb") as image:
+        await to_thread.run_sync(image.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await to_thread.run_sync(
+                image.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -1,16 +1,106 @@
 # Python
-from typing import Optional
+import csv
+import io
+import os
+from datetime import datetime
+from typing import List, Optional
 from enum import Enum
 
 # Pydantic
 from pydantic import BaseModel, EmailStr, Field
 
 # FastAPI
-from fastapi import (Cookie, FastAPI, File, UploadFile, status,
-                     Header, Body, Query, Path, Form, HTTPException)
+from fastapi import (Cookie, Depends, FastAPI, status,
+                     Header, Body, Query, Path, Form, HTTPException, Request,
+                     Response)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+
+# Storage
+from storage import DuplicateError, PersonFilter, create_store
+from security import PasswordHasher, Session, SessionTokens, split_token
+from contacts import ContactQueue, LogNotifier, SMTPNotifier
+from cache import ResponseCacheMiddleware, create_cache
+from serializers import ModelResponse, dumps, encode_model
+from batch import RequestStreamingResponse, import_records
+from metrics import Metrics, instrumented_route, save_profile
+from images import (ImageStore, MaxBodySizeMiddleware, MultipartFile,
+                    RangeNotSatisfiable, parse_range, read_range)
 
 app = FastAPI()
 
+metrics = Metrics(
+    profile_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    on_profile=save_profile(os.getenv("PROFILE_DIR", "profiles"))
+)
+app.router.route_class = instrumented_route(metrics)
+
+store = create_store(
+    os.getenv("DATABASE_URL"),
+    pool_size=int(os.getenv("DATABASE_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+)
+
+images = ImageStore(os.getenv("IMAGE_STORE_DIR", "media/images"))
+
+app.add_middleware(
+    MaxBodySizeMiddleware,
+    max_size=int(os.getenv("MAX_IMAGE_SIZE", str(10 * 1024 * 1024))),
+    paths=("/post-image",)
+)
+
+response_cache = create_cache(
+    os.getenv("CACHE_URL"),
+    max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "1024")),
+    ttl=float(os.getenv("CACHE_TTL", "60"))
+)
+
+app.add_middleware(
+    ResponseCacheMiddleware,
+    cache=response_cache,
+    paths=(r"/", r"/person/detail", r"/person/detail/\d+")
+)
+
+passwords = PasswordHasher(
+    max_workers=int(os.getenv("KDF_WORKERS", "2")),
+    max_queue=int(os.getenv("KDF_QUEUE", "16")),
+    import_workers=int(os.getenv("KDF_IMPORT_WORKERS", "1")),
+    import_cost=int(os.getenv("KDF_IMPORT_COST", str(2 ** 14)))
+)
+
+sessions = SessionTokens(
+    os.getenv("SESSION_SECRET"),
+    ttl=float(os.getenv("SESSION_TTL", "3600"))
+)
+
+contact_queue = ContactQueue(
+    store,
+    SMTPNotifier(
+        os.environ["CONTACT_SMTP_HOST"],
+        int(os.getenv("CONTACT_SMTP_PORT", "25")),
+        os.getenv("CONTACT_SMTP_FROM", "noreply@localhost"),
+        os.getenv("CONTACT_SMTP_TO", "contact@localhost")
+    ) if os.getenv("CONTACT_SMTP_HOST") else LogNotifier(),
+    maxsize=int(os.getenv("CONTACT_QUEUE_SIZE", "1000")),
+    batch_size=int(os.getenv("CONTACT_BATCH_SIZE", "50")),
+    workers=int(os.getenv("CONTACT_WORKERS", "2"))
+)
+
+
+@app.on_event("startup")
+async def open_store():
+    await store.connect()
+    await response_cache.connect()
+    await contact_queue.start()
+
+
+@app.on_event("shutdown")
+async def close_store():
+    await contact_queue.stop()
+    await store.close()
+    await response_cache.close()
+    passwords.close()
+
 # Models
 
 
@@ -47,6 +137,12 @@ class PersonBase(BaseModel):
 
 class Person(PersonBase):
 
+    username: Optional[str] = Field(
+        default=None,
+        min_length=1,
+        max_length=10,
+        example="valeryok"
+    )
     password: str = Field(..., min_length=8)
 
     # class Config:
@@ -65,6 +161,11 @@ class PersonOut(PersonBase):
     pass
 
 
+class PersonPage(BaseModel):
+    items: List[PersonOut]
+    next_cursor: Optional[int] = Field(default=None, example=50)
+
+
 class Location(BaseModel):
     city: str = Field(..., min_length=1, max_length=150)
     state: str = Field(..., min_length=1, max_length=150)
@@ -89,11 +190,60 @@ def home():
     """
     return {"hello": "world"}
 
+
+async def person_record(person: Person) -> dict:
+    """The person as it is saved, with the password hashed"""
+    record = person.dict()
+    record["password"] = await passwords.hash(person.password)
+    return record
+
+
+async def current_session(
+        authorization: Optional[str] = Header(default=None),
+        session: Optional[str] = Cookie(default=None)) -> Session:
+    """The session of the request, a 401 when there is no valid one
+
+    The token is checked without the KDF, the store only tells whether the
+    username or the password changed since the login.
+    """
+    token = split_token(authorization, session)
+    current = sessions.validate(token) if token else None
+    if current is None or not sessions.matches(
+            token, current, await store.get(current.person_id)):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="There is no valid session",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return current
+
+
+async def import_persons(persons: List[Person]) -> List[dict]:
+    """The persons of an import batch as they are saved"""
+    hashed = await passwords.hash_imports([person.password for person in persons])
+    return [{**person.dict(), "password": password}
+            for person, password in zip(persons, hashed)]
+
+
+@app.get(path="/metrics", status_code=status.HTTP_200_OK, tags=["Home"], summary="Prometheus metrics", response_class=PlainTextResponse)
+async def show_metrics():
+    """Prometheus metrics
+
+    Latency histograms of the validation, threadpool queue, handler and
+    serialization phases of every route, responses by status code and
+    the threadpool gauges.
+
+    Returns:
+    - The metrics in the Prometheus text format
+    """
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Request and Response Body
 
 
 @app.post(path="/person/new", response_model=PersonOut, status_code=status.HTTP_201_CREATED, tags=["Persons"], summary="Create Person in the app")
-def create_person(person: Person = Body(...)):
+async def create_person(person: Person = Body(...)):
     """Create Person
 
     This path operation creates a person in the app and save the information in the database
@@ -104,8 +254,72 @@ def create_person(person: Person = Body(...)):
 
     Returns:
     - A person model with first name, last name, age, hair color and marital status
+    - The "Location" header points to the detail of the new person
     """
-    return person
+    try:
+        person_id = await store.create(await person_record(person))
+    except DuplicateError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    await response_cache.invalidate(f"/person/detail/{person_id}")
+    return ModelResponse(
+        person,
+        PersonOut,
+        status_code=status.HTTP_201_CREATED,
+        headers={"Location": f"/person/detail/{person_id}"}
+    )
+
+
+@app.post(
+    path="/person/batch",
+    status_code=status.HTTP_200_OK,
+    tags=["Persons"],
+    summary="Create many Persons in the app",
+    openapi_extra={"requestBody": {"required": True, "content": {
+        "application/x-ndjson": {"schema": {"$ref": "#/components/schemas/Person"}},
+        "application/json": {"schema": {
+            "type": "array", "items": {"$ref": "#/components/schemas/Person"}}}
+    }}}
+)
+async def create_persons(
+        request: Request,
+        batch_size: int = Query(
+            500,
+            gt=0,
+            le=10000,
+            title="Batch size",
+            description="Persons saved in every transaction",
+            example=500
+        )):
+    """Create many Persons
+
+    This path operation reads a NDJSON body, or a JSON array, while it is
+    uploaded. Every record is validated as a Person and the valid ones are
+    saved in transactions of batch_size, so the memory used doesn't grow
+    with the size of the import.
+
+    The passwords are hashed on KDF_IMPORT_WORKERS threads, which limits an
+    import to about 17 rows per second and thread with the default
+    KDF_IMPORT_COST. A lower KDF_IMPORT_COST makes imports faster and the
+    imported passwords cheaper to crack.
+
+    Args:
+    - Request body: one Person per line, or a JSON array of Persons
+    - Request query parameter:
+        - **batch_size: int** -> Persons saved in every transaction
+
+    Returns:
+    - A NDJSON stream with {"line", "status", "errors"} for every record and a final {"created", "invalid"} summary
+    """
+    return RequestStreamingResponse(
+        import_records(
+            request.stream(),
+            Person,
+            import_persons,
+            store.create_many,
+            batch_size
+        ),
+        media_type="application/x-ndjson"
+    )
 
 # Validations query parameters
 
@@ -141,11 +355,9 @@ def show_person(
 
 # validations path parameters
 
-persons = [1, 2, 3, 4, 5]
-
 
 @app.get(path="/person/detail/{person_id}", status_code=status.HTTP_200_OK, tags=["Persons"], summary="Get a person")
-def show_person(
+async def show_person(
         person_id: int = Path(
             ...,
             title="Person id",
@@ -164,18 +376,152 @@ def show_person(
     Returns:
         _type_: _description_
     """
-    if person_id not in persons:
+    if await store.get(person_id) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="This person does not exist"
         )
     return {person_id: "It exists!"}
 
+# Listing
+
+
+def person_filter(
+        hair_color: Optional[HairColor] = Query(
+            None,
+            title="Hair color",
+            description="Only persons with this hair color",
+            example=HairColor.black
+        ),
+        age_min: Optional[int] = Query(
+            None,
+            gt=0,
+            le=115,
+            title="Minimum age",
+            example=18
+        ),
+        age_max: Optional[int] = Query(
+            None,
+            gt=0,
+            le=115,
+            title="Maximum age",
+            example=65
+        ),
+        name: Optional[str] = Query(
+            None,
+            min_length=1,
+            max_length=50,
+            title="Name prefix",
+            description="Only persons whose first name starts with it",
+            example="fac"
+        )) -> PersonFilter:
+    return PersonFilter(
+        hair_color=hair_color.value if hair_color is not None else None,
+        age_min=age_min,
+        age_max=age_max,
+        name_prefix=name
+    )
+
+
+@app.get(path="/persons", response_model=PersonPage, status_code=status.HTTP_200_OK, tags=["Persons"], summary="List persons")
+async def list_persons(
+        filters: PersonFilter = Depends(person_filter),
+        cursor: int = Query(
+            0,
+            ge=0,
+            title="Cursor",
+            description="The next_cursor of the previous page, 0 for the first page"
+        ),
+        limit: int = Query(50, gt=0, le=500, title="Page size")):
+    """List persons
+
+    Keyset pagination: every page starts after the id in the cursor, so
+    a page costs the same however deep it is. The filters are answered
+    from the indexes of the store.
+
+    Args:
+    - Request query parameters:
+        - **hair_color, age_min, age_max, name** -> filters
+        - **cursor: int** -> next_cursor of the previous page
+        - **limit: int** -> persons per page
+
+    Returns:
+    - The persons of the page and the next_cursor, null on the last page
+    """
+    persons = await store.list(filters, after=cursor, limit=limit + 1)
+    next_cursor = persons[limit - 1][0] if len(persons) > limit else None
+    return Response(
+        dumps({
+            "items": [encode_model(person, PersonOut) for _, person in persons[:limit]],
+            "next_cursor": next_cursor
+        }),
+        media_type="application/json"
+    )
+
+
+async def export_rows(filters: PersonFilter):
+    async for _, person in store.iter(filters):
+        yield encode_model(person, PersonOut)
+
+
+async def export_ndjson(filters: PersonFilter):
+    async for row in export_rows(filters):
+        yield dumps(row) + b"\n"
+
+
+async def export_csv(filters: PersonFilter):
+    fields = list(PersonOut.__fields__)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    async for row in export_rows(filters):
+        writer.writerow(row)
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+@app.get(path="/persons/export", status_code=status.HTTP_200_OK, tags=["Persons"], summary="Export persons")
+async def export_persons(
+        filters: PersonFilter = Depends(person_filter),
+        format: str = Query(
+            "ndjson",
+            regex="^(ndjson|csv)$",
+            title="Format",
+            description="ndjson or csv"
+        )):
+    """Export persons
+
+    The persons are read from the store as they are streamed, so the
+    memory used doesn't depend on how many persons are exported.
+
+    Args:
+    - Request query parameters:
+        - **hair_color, age_min, age_max, name** -> filters
+        - **format: str** -> ndjson or csv
+
+    Returns:
+    - Every PersonOut matching the filters
+    """
+    if format == "csv":
+        return StreamingResponse(
+            export_csv(filters),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="persons.csv"'}
+        )
+    return StreamingResponse(
+        export_ndjson(filters),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="persons.ndjson"'}
+    )
+
 # validations request body
 
 
-@app.put(path="/person/{peson_id}", status_code=status.HTTP_200_OK, tags=["Persons"], summary="Update person")
-def update_person(
+@app.put(path="/person/{person_id}", response_model=PersonOut, status_code=status.HTTP_200_OK, tags=["Persons"], summary="Update person")
+async def update_person(
         person_id: int = Path(
             ...,
             title="Person id",
@@ -186,43 +532,109 @@ def update_person(
         person: Person = Body(
             ...
         ),
+        current: Session = Depends(current_session)
         # location: Location = Body(...)
 ):
     """Update a Person by ID
 
+    Only the person of the session can update itself. A new username or
+    password ends every session of the person, the password is hashed
+    again only when it changes.
+
     Args:
         person_id (int, optional): _description_. Defaults to Path( ..., title="Person id", description="This is the person id. It's required and greate than 1", gt=0, example=43 ).
         person (Person, optional): _description_. Defaults to Body( ... ).
+        current (Session): the session of the bearer token or the cookie.
+
+    Raises:
+        HTTPException: 401 without a valid session, 403 for another person, 404 when the person does not exist, 409 when the username is taken
 
     Returns:
-        _type_: _description_
+        The PersonOut model of the person, without the password
     """
     # results = person.dict()
     # results.update(location.dic)
     # return results
-    return person
+    if current.person_id != person_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only the person of the session can be updated"
+        )
+    existing = await store.get(person_id)
+    if existing is not None and await passwords.verify(person.password, existing["password"]):
+        record = {**person.dict(), "password": existing["password"]}
+    else:
+        record = await person_record(person)
+    try:
+        updated = await store.update(person_id, record)
+    except DuplicateError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="This person does not exist"
+        )
+    await response_cache.invalidate(f"/person/detail/{person_id}")
+    return ModelResponse(person, PersonOut)
 
 # Form
 
 
 @app.post(path="/login", response_model=LoginOut, status_code=status.HTTP_200_OK, tags=["Persons"], summary="Signin")
-def login(username: str = Form(...), password: str = Form(...)):
+async def login(username: str = Form(...), password: str = Form(...)):
     """Start the sesion
 
+    The password is checked on the KDF threads, when too many logins are
+    waiting for them the answer is a 503.
+
     Args:
         username (str, optional): _description_. Defaults to Form(...).
         password (str, optional): _description_. Defaults to Form(...).
 
+    Raises:
+        HTTPException: 401 when the username or the password are wrong, 503 when the KDF is busy
+
     Returns:
-        _type_: _description_
+        The LoginOut model, the session token goes in the "session" cookie
     """
-    return LoginOut(username=username)
+    found = await store.get_by_username(username)
+    hashed = found[1]["password"] if found is not None else None
+    if not await passwords.verify(password, hashed) or found is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Wrong username or password"
+        )
+    token = sessions.issue(found[0], username, hashed)
+    response = ModelResponse(LoginOut(username=username), LoginOut)
+    response.set_cookie(
+        "session", token, max_age=int(sessions.ttl), httponly=True, samesite="lax")
+    return response
+
+
+@app.get(path="/login", response_model=LoginOut, status_code=status.HTTP_200_OK, tags=["Persons"], summary="Check the session")
+async def show_session(current: Session = Depends(current_session)):
+    """Check the session
+
+    The token is validated without the KDF, a password or username change
+    since the login ends the session.
+
+    Args:
+        current (Session): the session of the "Bearer <token>" Authorization header or of the cookie set by the login.
+
+    Raises:
+        HTTPException: 401 when there is no valid session
+
+    Returns:
+        The LoginOut model of the session
+    """
+    return ModelResponse(
+        LoginOut(username=current.username, message="Session is valid"), LoginOut)
 
 # Cookies and headers parameters
 
 
-@app.post(path="/contact", status_code=status.HTTP_200_OK, tags=["Home"])
-def contact(first_name: str = Form(..., max_length=20, min_length=1),
+@app.post(path="/contact", status_code=status.HTTP_202_ACCEPTED, tags=["Home"])
+async def contact(first_name: str = Form(..., max_length=20, min_length=1),
             last_name: str = Form(..., max_length=20, min_length=1),
             email: EmailStr = Form(...),
             message: str = Form(..., min_length=20),
@@ -230,7 +642,10 @@ def contact(first_name: str = Form(..., max_length=20, min_length=1),
             ads: Optional[str] = Cookie(default=None),
             summary="get in touch"
             ):
-    """_summary_
+    """Get in touch
+
+    The message is only queued here, background workers save it and send
+    the notification in batches. A full queue answers with a 503.
 
     Args:
         first_name (str, optional): _description_. Defaults to Form(..., max_length=20, min_length=1).
@@ -241,26 +656,130 @@ def contact(first_name: str = Form(..., max_length=20, min_length=1),
         ads (Optional[str], optional): _description_. Defaults to Cookie(default=None).
         summary (str, optional): _description_. Defaults to "get in touch".
 
+    Raises:
+        HTTPException: 503 when the queue is full or the app is stopping
+
     Returns:
         _type_: _description_
     """
+    contact_queue.submit({
+        "first_name": first_name,
+        "last_name": last_name,
+        "email": email,
+        "message": message,
+        "user_agent": user_agent,
+        "ads": ads,
+        "received_at": datetime.utcnow()
+    })
     return user_agent
 
 
 # Files
 
-@app.post(path="/post-image", status_code=status.HTTP_200_OK, tags=["Posts"], summary="Upload post-image")
-def post_image(image: UploadFile = File(...)):
-    """_summary_
+@app.post(
+    path="/post-image",
+    status_code=status.HTTP_200_OK,
+    tags=["Posts"],
+    summary="Upload post-image",
+    openapi_extra={"requestBody": {"required": True, "content": {
+        "multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["image"],
+            "properties": {"image": {"type": "string", "format": "binary"}}
+        }}
+    }}}
+)
+async def post_image(request: Request):
+    """Upload a post image
+
+    The image field of the form is parsed while it streams and goes
+    straight to a content addressed store, so an image that was already
+    uploaded is not written again. Only png, jpeg, gif and webp images
+    are accepted, checked by their content. Bodies bigger than
+    MAX_IMAGE_SIZE are rejected with a 413.
 
     Args:
-        image (UploadFile, optional): _description_. Defaults to File(...).
+        request (Request): the multipart/form-data request with the image.
+
+    Raises:
+        HTTPException: 415 when the file is not an accepted image
 
     Returns:
-        _type_: _description_
+        The filename, format, size and the url where the image is served
     """
+    upload = MultipartFile(
+        request.headers.get("content-type", ""), request.stream(), "image")
+    await upload.open()
+    stored = await images.save(upload)
     return {
-        "Filename": image.filename,
-        "Format": image.content_type,
-        "Size(kb)": round(len(image.file.read())/1024, ndigits=2)
+        "Filename": upload.filename,
+        "Format": stored.media_type,
+        "Size(kb)": round(stored.size/1024, ndigits=2),
+        "Url": f"/post-image/{stored.name}"
+    }
+
+
+@app.get(path="/post-image/{image_name}", status_code=status.HTTP_200_OK, tags=["Posts"], summary="Get post-image")
+async def show_image(
+        image_name: str = Path(
+            ...,
+            title="Image name",
+            description="The name returned in the url of the upload",
+        ),
+        range: Optional[str] = Header(default=None),
+        if_none_match: Optional[str] = Header(default=None)):
+    """Serve a stored post image
+
+    The name is the hash of the content, so it is used as a strong ETag
+    and the image can be cached forever. It is served with the type
+    checked on upload and nosniff, so browsers never guess another one.
+
+    Args:
+        image_name (str): the name of the image.
+        range (Optional[str], optional): a single "bytes=start-end" range, others are ignored.
+        if_none_match (Optional[str], optional): ETag the client already has.
+
+    Raises:
+        HTTPException: 404 when the image does not exist, 416 when the range can't be served
+
+    Returns:
+        The image, the requested part of it or a 304
+    """
+    path = images.path(image_name)
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="This image does not exist"
+        )
+    headers = {
+        "ETag": f'"{image_name}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff"
     }
+    if if_none_match and headers["ETag"] in (
+            tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    image_type = await run_in_threadpool(images.media_type, image_name)
+    byte_range = None
+    if range is not None:
+        size = os.path.getsize(path)
+        try:
+            byte_range = parse_range(range, size)
+        except RangeNotSatisfiable:
+            raise HTTPException(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                detail="This range can't be served",
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+    if byte_range is None:
+        return FileResponse(path, media_type=image_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        read_range(path, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=image_type,
+        headers=headers
+    )
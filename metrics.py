@@ -0,0 +1,294 @@
+# Python
+import asyncio
+import cProfile
+import logging
+import os
+import random
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Tuple
+
+# FastAPI
+from anyio import to_thread
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Histograms
+
+
+class Histogram:
+    """Prometheus style histogram with fixed buckets"""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Latency of every phase of the requests, by route
+
+    Args:
+        profile_rate (float): share of the requests profiled, 0 disables it.
+        on_profile: called in a thread with the route path and the
+            cProfile.Profile of every profiled request. Only the handler is
+            profiled: the thread running a sync handler, or the steps of an
+            async handler, not the other requests running between them.
+    """
+
+    def __init__(self, profile_rate: float = 0.0,
+                 on_profile: Optional[Callable[[str, cProfile.Profile], None]] = None):
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self.responses: Dict[Tuple[str, str, int], int] = {}
+        self.profile_rate = profile_rate
+        self.on_profile = on_profile
+        self._profiling = False
+
+    def observe(self, method: str, route: str, phase: str, seconds: float) -> None:
+        key = (method, route, phase)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, method: str, route: str, status: int) -> None:
+        key = (method, route, status)
+        self.responses[key] = self.responses.get(key, 0) + 1
+
+    def start_profile(self) -> Optional[cProfile.Profile]:
+        """A profile for a sampled request, one at a time, enabled by the handler"""
+        if self._profiling or not self.profile_rate \
+                or random.random() >= self.profile_rate:
+            return None
+        self._profiling = True
+        return cProfile.Profile()
+
+    async def stop_profile(self, route: str, profile: cProfile.Profile,
+                           handled: bool = True) -> None:
+        """End a profile, handed to on_profile when the handler ran
+
+        An error of the hook is logged, it never fails the request.
+        """
+        self._profiling = False
+        if self.on_profile is None or not handled:
+            return
+        try:
+            await to_thread.run_sync(self.on_profile, route, profile)
+        except Exception:
+            logger.exception("Saving the profile of %s failed", route)
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text format"""
+        lines = [
+            "# HELP http_request_phase_seconds Time spent in every phase of a request.",
+            "# TYPE http_request_phase_seconds histogram",
+        ]
+        for (method, route, phase), histogram in sorted(self.histograms.items()):
+            labels = f'method="{method}",route="{route}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'http_request_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(
+                f'http_request_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"http_request_phase_seconds_sum{{{labels}}} {histogram.total}")
+            lines.append(f"http_request_phase_seconds_count{{{labels}}} {histogram.count}")
+
+        lines += [
+            "# HELP http_responses_total Responses sent, by status code.",
+            "# TYPE http_responses_total counter",
+        ]
+        for (method, route, status), count in sorted(self.responses.items()):
+            lines.append(
+                f'http_responses_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+
+        limiter = to_thread.current_default_thread_limiter()
+        statistics = limiter.statistics()
+        lines += [
+            "# HELP threadpool_threads_total Threads the sync handlers can use.",
+            "# TYPE threadpool_threads_total gauge",
+            f"threadpool_threads_total {limiter.total_tokens}",
+            "# HELP threadpool_threads_busy Threads running a sync handler or other blocking call.",
+            "# TYPE threadpool_threads_busy gauge",
+            f"threadpool_threads_busy {statistics.borrowed_tokens}",
+            "# HELP threadpool_tasks_waiting Calls waiting for a free thread.",
+            "# TYPE threadpool_tasks_waiting gauge",
+            f"threadpool_tasks_waiting {statistics.tasks_waiting}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def save_profile(directory: str) -> Callable[[str, cProfile.Profile], None]:
+    """on_profile hook saving every profile as a .prof file in directory"""
+    def hook(route: str, profile: cProfile.Profile) -> None:
+        os.makedirs(directory, exist_ok=True)
+        name = route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "home"
+        profile.dump_stats(os.path.join(directory, f"{name}-{time.time_ns()}.prof"))
+    return hook
+
+# Route
+
+
+class RequestTiming:
+    __slots__ = ("submitted", "handler_start", "handler_end", "profile")
+
+    def __init__(self):
+        self.submitted = self.handler_start = self.handler_end = None
+        self.profile: Optional[cProfile.Profile] = None
+
+
+class _Profiled:
+    """Await a coroutine with the profile enabled only while it runs
+
+    The event loop runs other tasks between the steps of the coroutine,
+    the profile is disabled while it waits so they are not recorded.
+    """
+
+    def __init__(self, coroutine, profile: cProfile.Profile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self.profile.enable()
+            try:
+                if error is None:
+                    future = self.coroutine.send(value)
+                else:
+                    future = self.coroutine.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.profile.disable()
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+def _run_profiled(profile: Optional[cProfile.Profile], call: Callable, **values):
+    if profile is None:
+        return call(**values)
+    profile.enable()
+    try:
+        return call(**values)
+    finally:
+        profile.disable()
+
+
+_timing: ContextVar[Optional[RequestTiming]] = ContextVar("timing", default=None)
+
+
+def _instrument(call: Callable) -> Callable:
+    """Wrap an endpoint to record when it starts and ends
+
+    Sync endpoints are sent to the threadpool here instead of by FastAPI,
+    so the time waiting for a free thread is known.
+    """
+    if asyncio.iscoroutinefunction(call):
+        async def endpoint(**values):
+            timing = _timing.get()
+            if timing is None:
+                return await call(**values)
+            timing.handler_start = time.perf_counter()
+            try:
+                if timing.profile is not None:
+                    return await _Profiled(call(**values), timing.profile)
+                return await call(**values)
+            finally:
+                timing.handler_end = time.perf_counter()
+    else:
+        async def endpoint(**values):
+            timing = _timing.get()
+            if timing is None:
+                return await run_in_threadpool(call, **values)
+            timing.submitted = time.perf_counter()
+
+            def run():
+                timing.handler_start = time.perf_counter()
+                try:
+                    return _run_profiled(timing.profile, call, **values)
+                finally:
+                    timing.handler_end = time.perf_counter()
+
+            return await run_in_threadpool(run)
+    endpoint.instrumented = True
+    return endpoint
+
+
+def instrumented_route(metrics: Metrics):
+    """APIRoute class recording the phases of every request in metrics
+
+    The phases are: validation (reading the body, the parameters and the
+    dependencies), queue (waiting for a thread, sync handlers only),
+    handler, and serialization (the response model and the response).
+
+    Usage:
+        app.router.route_class = instrumented_route(metrics)
+    """
+
+    class InstrumentedRoute(APIRoute):
+
+        def get_route_handler(self) -> Callable:
+            if not getattr(self.dependant.call, "instrumented", False):
+                self.dependant.call = _instrument(self.dependant.call)
+            handler = super().get_route_handler()
+            route = self.path
+
+            async def instrumented_handler(request: Request):
+                timing = RequestTiming()
+                token = _timing.set(timing)
+                timing.profile = profile = metrics.start_profile()
+                start = time.perf_counter()
+                status = 500
+                try:
+                    response = await handler(request)
+                    status = response.status_code
+                    return response
+                except RequestValidationError:
+                    status = 422
+                    raise
+                except Exception as e:
+                    status = getattr(e, "status_code", 500)
+                    raise
+                finally:
+                    end = time.perf_counter()
+                    _timing.reset(token)
+                    method = request.method
+                    if timing.handler_start is None:
+                        metrics.observe(method, route, "validation", end - start)
+                    else:
+                        metrics.observe(method, route, "validation",
+                                        (timing.submitted or timing.handler_start) - start)
+                        if timing.submitted is not None:
+                            metrics.observe(method, route, "queue",
+                                            timing.handler_start - timing.submitted)
+                        metrics.observe(method, route, "handler",
+                                        timing.handler_end - timing.handler_start)
+                        metrics.observe(method, route, "serialization",
+                                        end - timing.handler_end)
+                    metrics.count(method, route, status)
+                    if profile is not None:
+                        await metrics.stop_profile(
+                            route, profile, handled=timing.handler_start is not None)
+
+            return instrumented_handler
+
+    return InstrumentedRoute
@@ -0,0 +1,237 @@
+# Python
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+# FastAPI
+from fastapi import HTTPException, status
+
+# Passwords
+
+
+def hash_password(password: str, n: int = 2 ** 14, r: int = 8, p: int = 1) -> str:
+    """Hash a password with scrypt
+
+    Returns:
+        "scrypt$n$r$p$salt$hash", salt and hash in base64
+    """
+    salt = secrets.token_bytes(16)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                         maxmem=256 * r * (n + p + 2), dklen=32)
+    return "$".join(["scrypt", str(n), str(r), str(p),
+                     base64.b64encode(salt).decode(), base64.b64encode(key).decode()])
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    """Check a password against a hash made by hash_password"""
+    try:
+        algorithm, n, r, p, salt, key = hashed.split("$")
+        n, r, p = int(n), int(r), int(p)
+    except ValueError:
+        return False
+    if algorithm != "scrypt":
+        return False
+    expected = base64.b64decode(key)
+    computed = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt),
+                              n=n, r=r, p=p, maxmem=256 * r * (n + p + 2),
+                              dklen=len(expected))
+    return hmac.compare_digest(computed, expected)
+
+
+class PasswordHasher:
+    """Run the password KDF on its own bounded pools of threads
+
+    scrypt releases the GIL, so a few dedicated threads keep it away from
+    the default threadpool used by the sync path operations. When more
+    than max_workers + max_queue logins or signups are pending new ones
+    get a 503.
+
+    Bulk imports use their own threads and never take a place in that
+    queue, they wait for a free import thread instead. A hash costs about
+    60ms of CPU with the default n=2**14, so every import thread adds only
+    about 17 rows per second. import_cost lowers n for imports, the hashes
+    keep their own parameters so verify() accepts both.
+
+    Args:
+        max_workers (int): threads running the KDF for logins and signups.
+        max_queue (int): calls allowed to wait for one of those threads.
+        import_workers (int): threads hashing the passwords of imports.
+        import_cost (int): scrypt n of the passwords of imports.
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 16,
+                 import_workers: int = 1, import_cost: int = 2 ** 14):
+        self.max_workers = max_workers
+        self.limit = max_workers + max_queue
+        self.pending = 0
+        self.import_workers = import_workers
+        self.import_cost = import_cost
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._import_executor: Optional[ThreadPoolExecutor] = None
+        # Compared against when the username does not exist, so the
+        # response takes the same time
+        self._dummy_hash = hash_password(secrets.token_hex(8))
+
+    async def _run(self, function, *args):
+        if self.pending >= self.limit:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins in progress, try again later",
+                headers={"Retry-After": "1"}
+            )
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="kdf")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    def _hash_imports(self, passwords: List[str]) -> List[str]:
+        return [hash_password(password, n=self.import_cost) for password in passwords]
+
+    async def hash_imports(self, passwords: List[str]) -> List[str]:
+        """Hash the passwords of an import batch on the import threads"""
+        if self._import_executor is None:
+            self._import_executor = ThreadPoolExecutor(
+                max_workers=self.import_workers, thread_name_prefix="kdf-import")
+        loop = asyncio.get_running_loop()
+        # One call per thread instead of one per password
+        size = -(-len(passwords) // self.import_workers) or 1
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(self._import_executor, self._hash_imports,
+                                 passwords[i:i + size])
+            for i in range(0, len(passwords), size)))
+        return [hashed for part in parts for hashed in part]
+
+    async def verify(self, password: str, hashed: Optional[str]) -> bool:
+        if hashed is None:
+            await self._run(verify_password, password, self._dummy_hash)
+            return False
+        return await self._run(verify_password, password, hashed)
+
+    def close(self) -> None:
+        for executor in (self._executor, self._import_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._import_executor = None
+
+# Sessions
+
+
+class Session(NamedTuple):
+    person_id: int
+    username: str
+    expires_at: float
+    credential: str
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SessionTokens:
+    """Signed session tokens, validated from memory after the first time
+
+    Tokens are "payload.signature" with an HMAC-SHA256 signature, so they
+    are checked without the KDF. Set SESSION_SECRET to share them between
+    workers, otherwise every process makes its own secret.
+
+    The payload has the credential of the person at the login, a
+    fingerprint of the username and the password hash. A token is only
+    valid while it matches the person in the store, so changing either
+    ends every session, in every worker.
+
+    Args:
+        secret (Optional[str]): the signing key.
+        ttl (float): seconds a token is valid.
+        max_entries (int): validated tokens kept in memory.
+    """
+
+    def __init__(self, secret: Optional[str] = None, ttl: float = 3600,
+                 max_entries: int = 10000):
+        self.secret = (secret or secrets.token_hex(32)).encode()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Session]" = OrderedDict()
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+
+    def credential(self, username: str, hashed: str) -> str:
+        """Fingerprint of the username and password hash of a person"""
+        return self._sign(f"{username}\0{hashed}")[:22]
+
+    def issue(self, person_id: int, username: str, hashed: str) -> str:
+        session = Session(person_id, username, time.time() + self.ttl,
+                          self.credential(username, hashed))
+        payload = _b64encode(json.dumps(session).encode())
+        token = f"{payload}.{self._sign(payload)}"
+        self._remember(token, session)
+        return token
+
+    def validate(self, token: str) -> Optional[Session]:
+        """The session of a token, None when it is invalid or expired"""
+        session = self._cache.get(token)
+        if session is None:
+            session = self._decode(token)
+            if session is None:
+                return None
+            self._remember(token, session)
+        else:
+            self._cache.move_to_end(token)
+        if session.expires_at <= time.time():
+            self._cache.pop(token, None)
+            return None
+        return session
+
+    def matches(self, token: str, session: Session, person: Optional[dict]) -> bool:
+        """Whether a validated session still belongs to the stored person
+
+        The token is forgotten when the person is gone or changed the
+        username or the password since the login.
+        """
+        if person is not None and hmac.compare_digest(
+                session.credential, self.credential(person["username"], person["password"])):
+            return True
+        self._cache.pop(token, None)
+        return False
+
+    def _decode(self, token: str) -> Optional[Session]:
+        payload, _, signature = token.partition(".")
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            return Session(*json.loads(_b64decode(payload)))
+        except (ValueError, TypeError):
+            return None
+
+    def _remember(self, token: str, session: Session) -> None:
+        self._cache[token] = session
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+
+def split_token(authorization: Optional[str], cookie: Optional[str]) -> Optional[str]:
+    """The token of a "Bearer" Authorization header or of the session cookie"""
+    if authorization:
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() == "bearer" and token:
+            return token
+    return cookie
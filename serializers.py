@@ -0,0 +1,119 @@
+# Python
+import json
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Tuple, Type, Union
+
+# Pydantic
+from pydantic import BaseModel
+
+# FastAPI
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Plans
+
+Plan = List[Tuple[str, str, Callable]]
+
+_plans: Dict[Type[BaseModel], Plan] = {}
+
+
+def _identity(value):
+    return value
+
+
+def _enum_value(value):
+    return value.value if isinstance(value, Enum) else value
+
+
+def model_plan(model: Type[BaseModel]) -> Plan:
+    """Fields written for a response model, computed once per model
+
+    Every entry is (attribute, key, encoder): the attribute read from the
+    returned object, the key written in the JSON and how the value is
+    encoded. Fields that are not in the response model (like the password
+    of a Person returned as PersonOut) are never read.
+
+    Args:
+        model (Type[BaseModel]): the response_model of the route.
+
+    Returns:
+        The plan of the model
+    """
+    plan = _plans.get(model)
+    if plan is None:
+        plan = []
+        for name, field in model.__fields__.items():
+            if isinstance(field.type_, type) and issubclass(field.type_, Enum):
+                encoder = _enum_value
+            elif field.type_ in (str, int, bool) and field.shape == 1:
+                encoder = _identity
+            else:
+                encoder = jsonable_encoder
+            plan.append((name, field.alias, encoder))
+        _plans[model] = plan
+    return plan
+
+
+def encode_model(content: Union[BaseModel, dict], model: Type[BaseModel]) -> dict:
+    """The JSON compatible dict of a trusted model, or of a row of the store"""
+    values = content if isinstance(content, dict) else content.__dict__
+    return {key: encoder(values[name]) for name, key, encoder in model_plan(model)}
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(
+        data,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def render_model(content: Union[BaseModel, dict], model: Type[BaseModel]) -> bytes:
+    """Encode a model already validated by the route as its response model
+
+    The bytes are the same FastAPI writes after validating the content
+    again as response_model and passing it through jsonable_encoder.
+
+    Args:
+        content (Union[BaseModel, dict]): the object returned by the handler.
+        model (Type[BaseModel]): the response_model of the route.
+
+    Returns:
+        The JSON body
+    """
+    return dumps(encode_model(content, model))
+
+# Responses
+
+
+class ModelResponse(Response):
+    """JSON response for a handler that returns a trusted model
+
+    Returning it from a route skips the response_model validation and
+    jsonable_encoder, keep response_model on the route for the docs.
+
+    Args:
+        content (BaseModel): the object returned by the handler.
+        model (Type[BaseModel]): the response_model of the route.
+        status_code (int): the status code of the route.
+        headers (Optional[dict]): extra response headers.
+    """
+
+    media_type = "application/json"
+
+    def __init__(self, content: BaseModel, model: Type[BaseModel],
+                 status_code: int = 200, headers: Optional[dict] = None):
+        self.model = model
+        super().__init__(content, status_code=status_code, headers=headers)
+
+    def render(self, content: BaseModel) -> bytes:
+        return render_model(content, self.model)
@@ -0,0 +1,469 @@
+# Python
+import asyncio
+import heapq
+import sys
+from bisect import bisect_left, bisect_right, insort
+from itertools import count, islice
+from typing import (AsyncIterator, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Tuple)
+
+# SQLAlchemy
+from sqlalchemy import (Boolean, Column, DateTime, Index, Integer, MetaData,
+                        String, Table, Text, UniqueConstraint, func, insert,
+                        select, update)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+# Tables
+
+metadata = MetaData()
+
+persons_table = Table(
+    "persons",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("first_name", String(50), nullable=False),
+    Column("last_name", String(50), nullable=False),
+    Column("age", Integer, nullable=False),
+    Column("hair_color", String(10), nullable=True),
+    Column("is_married", Boolean, nullable=True),
+    Column("password", String(255), nullable=False),
+    Column("username", String(10), nullable=True),
+    UniqueConstraint("username", name="uq_persons_username"),
+    Index("ix_persons_hair_color_id", "hair_color", "id"),
+    Index("ix_persons_age_id", "age", "id"),
+    Index("ix_persons_first_name_id", "first_name", "id"),
+)
+
+contacts_table = Table(
+    "contacts",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("first_name", String(20), nullable=False),
+    Column("last_name", String(20), nullable=False),
+    Column("email", String(320), nullable=False),
+    Column("message", Text, nullable=False),
+    Column("user_agent", Text, nullable=True),
+    Column("ads", Text, nullable=True),
+    Column("received_at", DateTime, nullable=False),
+)
+
+PERSON_FIELDS = tuple(
+    column.name for column in persons_table.columns if column.name != "id")
+
+
+def _person_row(data: dict) -> dict:
+    """Keep only the columns of the persons table
+
+    Enums are stored by value so both engines hold the same plain data.
+    """
+    row = {field: data.get(field) for field in PERSON_FIELDS}
+    if row["hair_color"] is not None:
+        row["hair_color"] = getattr(
+            row["hair_color"], "value", row["hair_color"])
+    return row
+
+
+class DuplicateError(ValueError):
+    """The username already belongs to another person"""
+
+
+def _raise_duplicate(error: IntegrityError) -> None:
+    """Raise a DuplicateError when the username constraint failed
+
+    Postgres names the constraint and sqlite names the column, any other
+    integrity error is left to the caller.
+    """
+    message = str(error.orig)
+    if "uq_persons_username" in message or "persons.username" in message:
+        raise DuplicateError("This username already exists") from error
+
+
+def _prefix_end(prefix: str) -> Optional[str]:
+    """The first string after every string starting with prefix
+
+    None when there is no such string, a prefix of only U+10FFFF.
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        # Surrogates can't be encoded for the database
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+
+class PersonFilter(NamedTuple):
+    hair_color: Optional[str] = None
+    age_min: Optional[int] = None
+    age_max: Optional[int] = None
+    name_prefix: Optional[str] = None
+
+    def matches(self, row: dict) -> bool:
+        return (
+            (self.hair_color is None or row["hair_color"] == self.hair_color)
+            and (self.age_min is None or row["age"] >= self.age_min)
+            and (self.age_max is None or row["age"] <= self.age_max)
+            and (not self.name_prefix or row["first_name"].startswith(self.name_prefix))
+        )
+
+# Engines
+
+
+class PersonStore:
+    """Storage backend used by the person and contact path operations
+
+    Every method is a coroutine so the handlers can await the store
+    instead of blocking a threadpool thread on I/O.
+    """
+
+    async def connect(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def create(self, data: dict) -> int:
+        raise NotImplementedError
+
+    async def create_many(self, rows: List[dict]) -> None:
+        """Create all the rows in a single transaction"""
+        raise NotImplementedError
+
+    async def get(self, person_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def get_by_username(self, username: str) -> Optional[Tuple[int, dict]]:
+        raise NotImplementedError
+
+    async def list(self, filters: PersonFilter, after: int = 0,
+                   limit: int = 50) -> List[Tuple[int, dict]]:
+        """The first persons with an id bigger than after, by id
+
+        Args:
+            filters (PersonFilter): conditions the persons must match.
+            after (int): id of the last person of the previous page.
+            limit (int): persons returned at most.
+
+        Returns:
+            (id, person) pairs
+        """
+        raise NotImplementedError
+
+    async def iter(self, filters: PersonFilter,
+                   page_size: int = 1000) -> AsyncIterator[Tuple[int, dict]]:
+        """Every person matching the filters, by id
+
+        Reads the persons page by page with list, a store that can keep
+        its position between pages does better.
+
+        Args:
+            filters (PersonFilter): conditions the persons must match.
+            page_size (int): persons read at once.
+
+        Yields:
+            (id, person) pairs
+        """
+        after = 0
+        while True:
+            persons = await self.list(filters, after=after, limit=page_size)
+            for person in persons:
+                yield person
+            if len(persons) < page_size:
+                return
+            after = persons[-1][0]
+
+    async def update(self, person_id: int, data: dict) -> bool:
+        raise NotImplementedError
+
+    async def save_contacts(self, messages: List[dict]) -> None:
+        """Save contact messages in a single transaction"""
+        raise NotImplementedError
+
+
+class MemoryPersonStore(PersonStore):
+    """Persons kept in a dict indexed by id
+
+    Only lives inside one process, use SQLPersonStore to share the data
+    between uvicorn workers. Sorted secondary indexes on hair color, age
+    and first name let the listing read only the persons that can match.
+    """
+
+    def __init__(self):
+        self._rows: Dict[int, dict] = {}
+        self._usernames: Dict[str, int] = {}
+        self._order: List[int] = []
+        self._by_hair_color: Dict[Optional[str], List[int]] = {}
+        self._by_age: Dict[int, List[int]] = {}
+        # (first_name, id) pairs, a prefix is a range of it
+        self._by_first_name: List[Tuple[str, int]] = []
+        self.contacts: List[dict] = []
+        self._ids = count(1)
+        self._lock = asyncio.Lock()
+
+    def _check_usernames(self, rows: List[dict], person_id: Optional[int] = None) -> None:
+        usernames = [row["username"] for row in rows if row["username"] is not None]
+        if len(set(usernames)) != len(usernames) or any(
+                self._usernames.get(username, person_id) != person_id
+                for username in usernames):
+            raise DuplicateError("This username already exists")
+
+    def _save(self, person_id: int, row: dict) -> None:
+        previous = self._rows.get(person_id)
+        if previous is None:
+            # Ids only grow, so appending keeps the order sorted
+            self._order.append(person_id)
+        else:
+            if previous["username"] is not None:
+                del self._usernames[previous["username"]]
+            _discard(self._by_hair_color[previous["hair_color"]], person_id)
+            _discard(self._by_age[previous["age"]], person_id)
+            _discard(self._by_first_name, (previous["first_name"], person_id))
+        if row["username"] is not None:
+            self._usernames[row["username"]] = person_id
+        insort(self._by_hair_color.setdefault(row["hair_color"], []), person_id)
+        insort(self._by_age.setdefault(row["age"], []), person_id)
+        insort(self._by_first_name, (row["first_name"], person_id))
+        self._rows[person_id] = row
+
+    def _candidates(self, filters: PersonFilter, after: int) -> Iterable[int]:
+        """Ids bigger than after in order, from the most selective index
+
+        The size of every index is counted from bisect positions, only
+        the smallest one is read.
+        """
+        options = [(_count_after(self._order, after),
+                    lambda: _ids_after(self._order, after))]
+        if filters.hair_color is not None:
+            ids = self._by_hair_color.get(filters.hair_color, [])
+            options.append((_count_after(ids, after), lambda: _ids_after(ids, after)))
+        if filters.age_min is not None or filters.age_max is not None:
+            ages = [ids for age, ids in self._by_age.items()
+                    if (filters.age_min is None or age >= filters.age_min)
+                    and (filters.age_max is None or age <= filters.age_max)]
+            options.append((sum(_count_after(ids, after) for ids in ages),
+                            lambda: heapq.merge(*(_ids_after(ids, after) for ids in ages))))
+        if filters.name_prefix:
+            end = _prefix_end(filters.name_prefix)
+            low = bisect_left(self._by_first_name, (filters.name_prefix,))
+            high = (bisect_left(self._by_first_name, (end,)) if end is not None
+                    else len(self._by_first_name))
+            # Sorted by name first, the ids of the range have to be sorted
+            names = self._by_first_name
+            options.append((high - low, lambda: iter(sorted(
+                names[i][1] for i in range(low, high) if names[i][1] > after))))
+        return min(options, key=lambda option: option[0])[1]()
+
+    def _matching(self, filters: PersonFilter, after: int) -> Iterator[Tuple[int, dict]]:
+        for person_id in self._candidates(filters, after):
+            row = self._rows[person_id]
+            if filters.matches(row):
+                yield person_id, dict(row)
+
+    async def create(self, data: dict) -> int:
+        row = _person_row(data)
+        async with self._lock:
+            self._check_usernames([row])
+            person_id = next(self._ids)
+            self._save(person_id, row)
+        return person_id
+
+    async def create_many(self, rows: List[dict]) -> None:
+        rows = [_person_row(data) for data in rows]
+        async with self._lock:
+            self._check_usernames(rows)
+            for row in rows:
+                self._save(next(self._ids), row)
+
+    async def get(self, person_id: int) -> Optional[dict]:
+        row = self._rows.get(person_id)
+        return dict(row) if row is not None else None
+
+    async def get_by_username(self, username: str) -> Optional[Tuple[int, dict]]:
+        person_id = self._usernames.get(username)
+        if person_id is None:
+            return None
+        return person_id, dict(self._rows[person_id])
+
+    async def list(self, filters: PersonFilter, after: int = 0,
+                   limit: int = 50) -> List[Tuple[int, dict]]:
+        return list(islice(self._matching(filters, after), limit))
+
+    async def iter(self, filters: PersonFilter,
+                   page_size: int = 1000) -> AsyncIterator[Tuple[int, dict]]:
+        # One pass over the chosen index instead of choosing it for every page
+        for person in self._matching(filters, 0):
+            yield person
+
+    async def update(self, person_id: int, data: dict) -> bool:
+        row = _person_row(data)
+        async with self._lock:
+            if person_id not in self._rows:
+                return False
+            self._check_usernames([row], person_id)
+            self._save(person_id, row)
+        return True
+
+    async def save_contacts(self, messages: List[dict]) -> None:
+        self.contacts.extend(dict(message) for message in messages)
+
+
+def _ids_after(ids: List[int], after: int) -> Iterator[int]:
+    """The ids of a sorted list bigger than after, without copying it
+
+    The position is found again when the list changed between two ids.
+    """
+    position = bisect_right(ids, after)
+    while position < len(ids):
+        after = ids[position]
+        yield after
+        if position < len(ids) and ids[position] == after:
+            position += 1
+        else:
+            position = bisect_right(ids, after)
+
+
+def _count_after(ids: List[int], after: int) -> int:
+    """How many ids of a sorted list are bigger than after"""
+    return len(ids) - bisect_right(ids, after)
+
+
+def _discard(values: list, value) -> None:
+    """Remove a value from a sorted list"""
+    position = bisect_left(values, value)
+    if position < len(values) and values[position] == value:
+        del values[position]
+
+
+def create_engine(url: str, **options) -> AsyncEngine:
+    """Async engine for a database url
+
+    An in-memory sqlite database only exists inside a single connection,
+    so it gets one connection shared by every task.
+    """
+    if url.rstrip("/").endswith(("sqlite+aiosqlite:", ":memory:")):
+        options.update(poolclass=StaticPool,
+                       connect_args={"check_same_thread": False})
+    return create_async_engine(url, **options)
+
+
+class SQLPersonStore(PersonStore):
+    """Persons kept in a SQL database through an async SQLAlchemy engine
+
+    Args:
+        url (str): async database url, e.g. "postgresql+asyncpg://..." or
+            "sqlite+aiosqlite://" for tests.
+        pool_size (int): connections kept open in the pool.
+        max_overflow (int): extra connections allowed under load.
+    """
+
+    def __init__(self, url: str, pool_size: int = 5, max_overflow: int = 10):
+        options = {"pool_pre_ping": True}
+        if not url.startswith("sqlite"):
+            options.update(pool_size=pool_size, max_overflow=max_overflow)
+        self.engine = create_engine(url, **options)
+
+    async def connect(self) -> None:
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+
+    async def close(self) -> None:
+        await self.engine.dispose()
+
+    async def create(self, data: dict) -> int:
+        try:
+            async with self.engine.begin() as conn:
+                result = await conn.execute(
+                    insert(persons_table).values(**_person_row(data)))
+                return result.inserted_primary_key[0]
+        except IntegrityError as e:
+            _raise_duplicate(e)
+            raise
+
+    async def create_many(self, rows: List[dict]) -> None:
+        if not rows:
+            return
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(
+                    insert(persons_table), [_person_row(data) for data in rows])
+        except IntegrityError as e:
+            _raise_duplicate(e)
+            raise
+
+    async def get(self, person_id: int) -> Optional[dict]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(persons_table).where(persons_table.c.id == person_id))
+            row = result.mappings().first()
+        if row is None:
+            return None
+        return {field: row[field] for field in PERSON_FIELDS}
+
+    async def get_by_username(self, username: str) -> Optional[Tuple[int, dict]]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(persons_table).where(persons_table.c.username == username))
+            row = result.mappings().first()
+        if row is None:
+            return None
+        return row["id"], {field: row[field] for field in PERSON_FIELDS}
+
+    async def list(self, filters: PersonFilter, after: int = 0,
+                   limit: int = 50) -> List[Tuple[int, dict]]:
+        columns = persons_table.c
+        query = select(persons_table).where(columns.id > after)
+        if filters.hair_color is not None:
+            query = query.where(columns.hair_color == filters.hair_color)
+        if filters.age_min is not None:
+            query = query.where(columns.age >= filters.age_min)
+        if filters.age_max is not None:
+            query = query.where(columns.age <= filters.age_max)
+        if filters.name_prefix:
+            # The range uses the index, substr keeps it exact for any collation
+            prefix = filters.name_prefix
+            end = _prefix_end(prefix)
+            query = query.where(
+                columns.first_name >= prefix,
+                func.substr(columns.first_name, 1, len(prefix)) == prefix)
+            if end is not None:
+                query = query.where(columns.first_name < end)
+        query = query.order_by(columns.id).limit(limit)
+        async with self.engine.connect() as conn:
+            result = await conn.execute(query)
+            rows = result.mappings().all()
+        return [(row["id"], {field: row[field] for field in PERSON_FIELDS})
+                for row in rows]
+
+    async def update(self, person_id: int, data: dict) -> bool:
+        try:
+            async with self.engine.begin() as conn:
+                result = await conn.execute(
+                    update(persons_table)
+                    .where(persons_table.c.id == person_id)
+                    .values(**_person_row(data)))
+                return result.rowcount == 1
+        except IntegrityError as e:
+            _raise_duplicate(e)
+            raise
+
+    async def save_contacts(self, messages: List[dict]) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(contacts_table), messages)
+
+
+def create_store(url: Optional[str] = None, **options) -> PersonStore:
+    """Build the store for a database url
+
+    Args:
+        url (Optional[str]): database url, the in-memory store is used when empty.
+        options: pool settings passed to SQLPersonStore.
+
+    Returns:
+        The PersonStore for that url
+    """
+    if not url:
+        return MemoryPersonStore()
+    return SQLPersonStore(url, **options)
@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+import pytest
+from pydantic import BaseModel
+
+from batch import import_records, iter_json_array, iter_ndjson, iter_records
+from storage import DuplicateError
+
+
+async def stream(parts):
+    for part in parts:
+        yield part
+
+
+def parse(parser, parts, **options):
+    async def collect():
+        return [item async for item in parser(stream(parts), **options)]
+    return asyncio.run(collect())
+
+
+def records(items):
+    return [(number, record if not isinstance(record, json.JSONDecodeError) else "error")
+            for number, record in items]
+
+# Array
+
+
+def test_array_items_split_across_chunks():
+    parts = ['[{"a": 1', '}, 12', '3, "x', 'y", [1, 2]', ']']
+    assert records(parse(iter_json_array, parts)) == [
+        (1, {"a": 1}), (2, 123), (3, "xy"), (4, [1, 2])]
+
+
+@pytest.mark.parametrize("parts,valid", [
+    (['[{"a": 1}, {"a" 2}, {"a": 3}]'], 1),
+    (['[{"a": 1} {"a": 2}]'], 1),
+    (['{"a": 1}'], 0),
+    (['[{"a": 1},'], 1),
+])
+def test_malformed_array(parts, valid):
+    items = records(parse(iter_json_array, parts))
+    assert items == [(1, {"a": 1})][:valid] + [(valid + 1, "error")]
+
+
+def test_malformed_array_stops_reading():
+    read = []
+
+    async def body():
+        for part in ['[{"a": tru', 'e}, {"b" 2}, '] + ['{"c": 3}, ' * 100] * 1000:
+            read.append(part)
+            yield part
+
+    async def collect():
+        return [item async for item in iter_json_array(body(), max_item_size=1000)]
+
+    items = asyncio.run(collect())
+    assert records(items) == [(1, {"a": True}), (2, "error")]
+    assert items[1][1].msg == "Expecting ':' delimiter"
+    assert len(read) < 10
+
+
+def test_array_item_over_size():
+    items = parse(iter_json_array, ["[1, ", '"' + "x" * 50, 'y"]'], max_item_size=20)
+    assert records(items) == [(1, 1), (2, "error")]
+
+# NDJSON
+
+
+def test_ndjson_lines_split_across_chunks():
+    parts = ['{"a": 1}\n{"a"', ': 2}\n\n', "not json\n", '{"a": 3}']
+    assert records(parse(iter_ndjson, parts)) == [
+        (1, {"a": 1}), (2, {"a": 2}), (4, "error"), (5, {"a": 3})]
+
+
+def test_ndjson_line_over_size_is_skipped():
+    parts = ['{"a": 1}\n"' + "x" * 30, "x" * 30, 'x"\n{"a": 2}\n', '"' + "y" * 30]
+    items = parse(iter_ndjson, parts, max_item_size=20)
+    assert records(items) == [(1, {"a": 1}), (2, "error"), (3, {"a": 2}), (4, "error")]
+    assert items[1][1].msg == "Line longer than 20 characters"
+
+
+def test_records_picks_the_format():
+    def body(text):
+        return stream([text.encode()[i:i + 3] for i in range(0, len(text.encode()), 3)])
+
+    async def collect(text):
+        return [item async for item in iter_records(body(text))]
+
+    assert asyncio.run(collect('  [{"é": 1}, 2]')) == [(1, {"é": 1}), (2, 2)]
+    assert asyncio.run(collect('{"é": 1}\n2\n')) == [(1, {"é": 1}), (2, 2)]
+
+# Import
+
+
+class Item(BaseModel):
+    name: str
+
+
+def test_import_splits_a_refused_batch():
+    prepared = []
+    transactions = []
+    saved = []
+
+    async def prepare(models):
+        prepared.extend(model.name for model in models)
+        return [model.dict() for model in models]
+
+    async def save_many(rows):
+        transactions.append(len(rows))
+        if any(row["name"] == "taken" for row in rows):
+            raise DuplicateError("This username already exists")
+        saved.extend(row["name"] for row in rows)
+
+    names = ["a", "b", "taken", "c", "d", "e", "f", "g"]
+    body = "".join(json.dumps({"name": name}) + "\n" for name in names) + '{"age": 1}\n'
+
+    async def collect():
+        lines = [line async for line in import_records(
+            stream([body.encode()]), Item, prepare, save_many, batch_size=100)]
+        return [json.loads(line) for line in b"".join(lines).decode().splitlines()]
+
+    reports = asyncio.run(collect())
+    assert prepared == names
+    assert sorted(saved) == sorted(set(names) - {"taken"})
+    assert [report["status"] for report in reports[:-1]] == \
+        ["created"] * 2 + ["invalid"] + ["created"] * 5 + ["invalid"]
+    assert reports[2]["errors"][0]["msg"] == "This username already exists"
+    assert reports[-1] == {"created": 7, "invalid": 2}
+    # Halves instead of a transaction per row
+    assert len(transactions) < len(names)
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from cache import CachedResponse, ResponseCacheMiddleware, create_cache
+
+RESPONSE = CachedResponse(200, [(b"content-type", b"application/json")], b"{}", '"tag"')
+
+
+@pytest.fixture(params=[None, "sqlite+aiosqlite://"], ids=["memory", "sqlite"])
+def url(request):
+    return request.param
+
+
+def run(url, test, **options):
+    """Run a coroutine against a connected cache"""
+    cache = create_cache(url, **options)
+
+    async def main():
+        await cache.connect()
+        try:
+            return await test(cache)
+        finally:
+            await cache.close()
+    return asyncio.run(main())
+
+# Backends
+
+
+def test_lru_eviction():
+    async def test(cache):
+        for key in ("/a", "/b"):
+            await cache.set(key, key, RESPONSE)
+        await cache.get("/a")
+        await cache.set("/c", "/c", RESPONSE)
+        assert await cache.get("/a") == RESPONSE
+        assert await cache.get("/b") is None
+        assert await cache.get("/c") == RESPONSE
+    run(None, test, max_entries=2)
+
+
+def test_ttl_expiry(url):
+    async def test(cache):
+        await cache.set("/a", "/a", RESPONSE)
+        assert await cache.get("/a") == RESPONSE
+        await asyncio.sleep(0.2)
+        assert await cache.get("/a") is None
+        await cache.set("/a", "/a", RESPONSE)
+        assert await cache.get("/a") == RESPONSE
+    run(url, test, ttl=0.1)
+
+
+def test_invalidate_every_query(url):
+    async def test(cache):
+        for key in ("/a", "/a?x=1", "/a?x=2", "/b?x=1"):
+            await cache.set(key.split("?")[0], key, RESPONSE)
+        await cache.invalidate("/a")
+        assert [await cache.get(key) for key in ("/a", "/a?x=1", "/a?x=2")] == [None] * 3
+        assert await cache.get("/b?x=1") == RESPONSE
+    run(url, test)
+
+# Middleware
+
+
+@pytest.fixture
+def client(url):
+    calls = []
+
+    async def item(request):
+        calls.append(request.url.path)
+        status = 200 if request.path_params["name"] != "missing" else 404
+        return JSONResponse({"name": request.path_params["name"],
+                             "query": dict(request.query_params)}, status_code=status)
+
+    cache = create_cache(url)
+    app = Starlette(routes=[Route("/items/{name}", item, methods=["GET", "POST"])],
+                    on_startup=[cache.connect], on_shutdown=[cache.close])
+    app.add_middleware(ResponseCacheMiddleware, cache=cache, paths=(r"/items/\w+",))
+    with TestClient(app) as client:
+        client.calls = calls
+        client.cache = cache
+        yield client
+
+
+def test_replay_and_not_modified(client):
+    first = client.get("/items/a")
+    second = client.get("/items/a")
+    assert first.content == second.content
+    assert first.headers["etag"] == second.headers["etag"]
+    assert client.calls == ["/items/a"]
+    for if_none_match in (first.headers["etag"], f'"other", {first.headers["etag"]}', "*"):
+        response = client.get("/items/a", headers={"if-none-match": if_none_match})
+        assert (response.status_code, response.content) == (304, b"")
+        assert response.headers["etag"] == first.headers["etag"]
+    assert client.get("/items/a", headers={"if-none-match": '"other"'}).status_code == 200
+    assert client.calls == ["/items/a"]
+
+
+def test_sorted_query_is_the_same_key(client):
+    first = client.get("/items/a?x=1&y=2")
+    assert client.get("/items/a?y=2&x=1").content == first.content
+    assert client.get("/items/a?x=2&y=2").content != first.content
+    assert len(client.calls) == 2
+
+
+def test_only_200_get_responses_are_cached(client):
+    for _ in range(2):
+        assert client.get("/items/missing").status_code == 404
+        client.post("/items/a")
+    assert client.calls == ["/items/missing", "/items/a"] * 2
+
+
+def test_invalidate(client):
+    client.get("/items/a?x=1")
+    client.get("/items/a?x=2")
+    client.portal.call(client.cache.invalidate, "/items/a")
+    client.get("/items/a?x=1")
+    client.get("/items/a?x=2")
+    assert len(client.calls) == 4
@@ -0,0 +1,193 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+import contacts
+import main
+from contacts import ContactQueue, Notifier, SMTPNotifier
+
+
+class Store:
+    """Records every batch, fails the attempts listed in errors
+
+    Saving waits while a test holds the release event.
+    """
+
+    def __init__(self, errors=(), refused=()):
+        self.batches = []
+        self.errors = list(errors)
+        self.refused = set(refused)
+        self.release = None
+
+    async def save_contacts(self, messages):
+        if self.release is not None:
+            await self.release.wait()
+        if self.errors:
+            raise self.errors.pop(0)
+        if any(message["email"] in self.refused for message in messages):
+            raise IntegrityError("INSERT", {}, Exception("NOT NULL"))
+        self.batches.append([message["email"] for message in messages])
+
+
+class Recorder(Notifier):
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+
+    async def send(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionRefusedError("SMTP is down")
+        self.sent.append([message["email"] for message in messages])
+
+
+def message(number):
+    return {"first_name": "a", "last_name": "b", "email": f"{number}@example.com",
+            "message": "x" * 20}
+
+
+def run(test, store, notifier=None, **options):
+    queue = ContactQueue(store, notifier or Recorder(), max_delay=0.01, **options)
+
+    async def main():
+        await queue.start()
+        try:
+            return await test(queue)
+        finally:
+            await queue.stop(timeout=5)
+    return asyncio.run(main())
+
+# Queue
+
+
+def test_batches_up_to_batch_size():
+    store = Store()
+    notifier = Recorder()
+
+    async def test(queue):
+        store.release = asyncio.Event()
+        for number in range(10):
+            queue.submit(message(number))
+        await asyncio.sleep(0.01)
+        store.release.set()
+    run(test, store, notifier, batch_size=4, workers=1)
+    assert [len(batch) for batch in store.batches] == [4, 4, 2]
+    assert notifier.sent == store.batches
+
+
+def test_stop_drains_the_queue():
+    store = Store()
+
+    async def test(queue):
+        for number in range(25):
+            queue.submit(message(number))
+    run(test, store, batch_size=10, linger=0.1)
+    assert sorted(email for batch in store.batches for email in batch) == \
+        sorted(message(number)["email"] for number in range(25))
+
+
+def test_full_or_stopped_queue_is_a_503():
+    store = Store()
+
+    async def test(queue):
+        store.release = asyncio.Event()
+        queue.submit(message(0))
+        await asyncio.sleep(0.01)
+        # The worker holds the first one, two more fill the queue
+        queue.submit(message(1))
+        queue.submit(message(2))
+        with pytest.raises(HTTPException) as error:
+            queue.submit(message(3))
+        assert error.value.status_code == 503
+        assert error.value.headers == {"Retry-After": "1"}
+        store.release.set()
+        await queue.stop(timeout=5)
+        with pytest.raises(HTTPException) as error:
+            queue.submit(message(4))
+        assert error.value.status_code == 503
+    run(test, store, maxsize=2, batch_size=1, workers=1)
+    assert store.batches == [[message(number)["email"]] for number in range(3)]
+
+
+def test_transient_errors_are_retried():
+    store = Store(errors=[OperationalError("INSERT", {}, Exception("gone")),
+                          ConnectionResetError()])
+    notifier = Recorder(failures=2)
+
+    async def test(queue):
+        queue.submit(message(0))
+    run(test, store, notifier, retries=3)
+    assert store.batches == [["0@example.com"]]
+    assert notifier.sent == [["0@example.com"]]
+
+
+def test_notifier_gives_up_after_the_retries(caplog):
+    notifier = Recorder(failures=5)
+
+    async def test(queue):
+        queue.submit(message(0))
+    run(test, Store(), notifier, retries=3)
+    assert notifier.sent == []
+    assert notifier.failures == 2
+    assert "notification failed, attempt 3 of 3" in caplog.text
+
+
+def test_refused_message_is_dropped_alone(caplog):
+    store = Store(refused={"3@example.com"})
+    notifier = Recorder()
+
+    async def test(queue):
+        store.release = asyncio.Event()
+        for number in range(8):
+            queue.submit(message(number))
+        await asyncio.sleep(0.01)
+        store.release.set()
+    run(test, store, notifier, batch_size=7, workers=1)
+    saved = sorted(email for batch in store.batches for email in batch)
+    assert saved == sorted(message(number)["email"] for number in range(8) if number != 3)
+    assert "Dropped a contact message the store refuses" in caplog.text
+    assert "3@example.com" in caplog.text
+    assert sorted(email for batch in notifier.sent for email in batch) == saved
+
+# Notifier
+
+
+def test_smtp_notifier(monkeypatch):
+    sent = []
+
+    class SMTP:
+        def __init__(self, host, port, timeout):
+            sent.append((host, port))
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def send_message(self, email):
+            sent.append(email)
+
+    monkeypatch.setattr(contacts.smtplib, "SMTP", SMTP)
+    notifier = SMTPNotifier("mail", 2525, "noreply@localhost", "contact@localhost")
+    asyncio.run(notifier.send([message(0), message(1)]))
+    assert sent[0] == ("mail", 2525)
+    assert sent[1]["Subject"] == "2 new contact messages"
+    assert sent[1]["To"] == "contact@localhost"
+    assert "<1@example.com>" in sent[1].get_content()
+
+# Path operation
+
+
+def test_contact_is_accepted():
+    form = {"first_name": "facundo", "last_name": "cabrera", "email": "f@example.com",
+            "message": "Hello, I would like to know more"}
+    with TestClient(main.app) as client:
+        response = client.post("/contact", data=form, headers={"user-agent": "tests"})
+        assert response.status_code == 202
+        assert response.json() == "tests"
+        assert client.post("/contact", data={**form, "message": "short"}).status_code == 422
@@ -0,0 +1,132 @@
+import asyncio
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+import main
+from images import MaxBodySizeMiddleware, RangeNotSatisfiable, parse_range
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.images, "root", str(tmp_path))
+    with TestClient(main.app) as client:
+        yield client
+
+
+def upload(client, content, filename="image.png", content_type="image/png"):
+    return client.post("/post-image", files={"image": (filename, content, content_type)})
+
+
+def stored_files(root):
+    return sorted(name for _, _, names in os.walk(root) for name in names)
+
+# Upload
+
+
+def test_upload_dedup(client, tmp_path):
+    first = upload(client, PNG)
+    second = upload(client, PNG, "page.html", "text/html")
+    assert first.status_code == second.status_code == 200
+    assert first.json()["Url"] == second.json()["Url"]
+    assert second.json()["Format"] == "image/png"
+    name = first.json()["Url"].rsplit("/", 1)[1]
+    assert stored_files(tmp_path) == [name, name + ".type"]
+
+
+@pytest.mark.parametrize("content", [b"<script>alert(1)</script>", b"\x89P", b""])
+def test_upload_sniffing(client, tmp_path, content):
+    response = upload(client, content, "image.png", "image/png")
+    assert response.status_code == 415
+    assert stored_files(tmp_path) == []
+
+
+def test_upload_without_image(client):
+    assert client.post("/post-image", files={"other": ("a.png", PNG)}).status_code == 422
+
+# Body size limit
+
+
+def limited_app(max_size):
+    async def app(scope, receive, send):
+        body = await Request(scope, receive).body()
+        await JSONResponse({"size": len(body)})(scope, receive, send)
+    return MaxBodySizeMiddleware(app, max_size, paths=("/upload",))
+
+
+def call(app, chunks, headers=()):
+    scope = {"type": "http", "method": "POST", "path": "/upload",
+             "headers": list(headers), "query_string": b""}
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def test_body_size_from_content_length():
+    status, _ = call(limited_app(10), [b"x" * 5], [(b"content-length", b"11")])
+    assert status == 413
+
+
+def test_body_size_while_streaming():
+    status, _ = call(limited_app(10), [b"x" * 6, b"x" * 6])
+    assert status == 413
+    status, body = call(limited_app(10), [b"x" * 5, b"x" * 5])
+    assert (status, body) == (200, b'{"size":10}')
+
+# Serving
+
+
+def test_etag_and_ranges(client):
+    url = upload(client, PNG).json()["Url"]
+    response = client.get(url)
+    assert response.content == PNG
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["x-content-type-options"] == "nosniff"
+
+    etag = response.headers["etag"]
+    cached = client.get(url, headers={"if-none-match": f'"other", {etag}'})
+    assert cached.status_code == 304
+    assert cached.headers["x-content-type-options"] == "nosniff"
+
+    part = client.get(url, headers={"range": "bytes=2-9"})
+    assert part.status_code == 206
+    assert part.content == PNG[2:10]
+    assert part.headers["content-range"] == f"bytes 2-9/{len(PNG)}"
+    assert client.get(url, headers={"range": "bytes=-4"}).content == PNG[-4:]
+
+    for ignored in ("bytes=abc", "bytes=0-0,5-6", "bytes=9-2", "items=0-1"):
+        response = client.get(url, headers={"range": ignored})
+        assert (response.status_code, response.content) == (200, PNG)
+
+    response = client.get(url, headers={"range": f"bytes={len(PNG)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(PNG)}"
+
+
+def test_unknown_images(client):
+    assert client.get("/post-image/" + "0" * 64).status_code == 404
+    assert client.get("/post-image/" + "0" * 64 + ".type").status_code == 404
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-", 10) == (0, 9)
+    assert parse_range("bytes=5-100", 10) == (5, 9)
+    assert parse_range("bytes=-20", 10) == (0, 9)
+    assert parse_range("bytes=-", 10) is None
+    for header in ("bytes=10-", "bytes=-0"):
+        with pytest.raises(RangeNotSatisfiable):
+            parse_range(header, 10)
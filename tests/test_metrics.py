@@ -0,0 +1,87 @@
+import re
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from fastapi.testclient import TestClient
+
+from metrics import BUCKETS, Metrics, instrumented_route
+
+
+def create_app(metrics):
+    app = FastAPI()
+    app.router.route_class = instrumented_route(metrics)
+
+    @app.get("/sync")
+    def sync_route():
+        time.sleep(0.03)
+        return {}
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def show_metrics():
+        return metrics.render()
+
+    return app
+
+
+def samples(text, name):
+    """{labels: value} of a metric in the Prometheus text format"""
+    return {labels: float(value) for labels, value in re.findall(
+        rf"^{name}\{{(.*)\}} (\S+)$", text, re.MULTILINE)}
+
+
+def test_phases_and_render():
+    metrics = Metrics()
+    with TestClient(create_app(metrics)) as client:
+        for _ in range(3):
+            client.get("/sync")
+        client.get("/items/1")
+        client.get("/items/x")
+        text = client.get("/metrics").text
+
+    counts = samples(text, "http_request_phase_seconds_count")
+    sync = 'method="GET",route="/sync",phase="{}"'
+    for phase in ("validation", "queue", "handler", "serialization"):
+        assert counts[sync.format(phase)] == 3
+    sums = samples(text, "http_request_phase_seconds_sum")
+    assert sums[sync.format("handler")] >= 0.09
+    assert sums[sync.format("queue")] < sums[sync.format("handler")]
+
+    # Async handlers have no queue, a 422 only has its validation
+    item = 'method="GET",route="/items/{{item_id}}",phase="{}"'
+    assert counts[item.format("validation")] == 2
+    assert counts[item.format("handler")] == 1
+    assert item.format("queue") not in counts
+
+    buckets = samples(text, "http_request_phase_seconds_bucket")
+    handler = [value for labels, value in buckets.items()
+               if labels.startswith(sync.format("handler"))]
+    assert len(handler) == len(BUCKETS) + 1
+    assert handler == sorted(handler)
+    assert buckets[sync.format("handler") + ',le="+Inf"'] == 3
+    assert buckets[sync.format("handler") + ',le="0.025"'] == 0
+
+    responses = samples(text, "http_responses_total")
+    assert responses['method="GET",route="/sync",status="200"'] == 3
+    assert responses['method="GET",route="/items/{item_id}",status="422"'] == 1
+    assert "# TYPE threadpool_threads_busy gauge" in text
+
+
+def test_profile_hook_errors_are_not_request_errors(caplog):
+    profiled = []
+
+    def hook(route, profile):
+        profiled.append(route)
+        raise PermissionError("profiles is not writable")
+
+    metrics = Metrics(profile_rate=1.0, on_profile=hook)
+    with TestClient(create_app(metrics)) as client:
+        assert client.get("/items/1").status_code == 200
+        # A request that never reached its handler has nothing to save
+        assert client.get("/items/x").status_code == 422
+    assert profiled == ["/items/{item_id}"]
+    assert "Saving the profile of /items/{item_id} failed" in caplog.text
@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+from security import PasswordHasher, SessionTokens, hash_password, split_token, verify_password
+
+# Passwords
+
+
+def test_hash_and_verify():
+    hashed = hash_password("12345678", n=2 ** 4)
+    assert hashed.startswith("scrypt$16$8$1$")
+    assert verify_password("12345678", hashed)
+    assert not verify_password("12345679", hashed)
+    assert hash_password("12345678", n=2 ** 4) != hashed
+    for broken in ("", "bcrypt$16$8$1$a$b", "scrypt$x$8$1$a$b"):
+        assert not verify_password("12345678", broken)
+
+
+def test_hasher_round_trip():
+    async def test():
+        hasher = PasswordHasher(import_cost=2 ** 4)
+        try:
+            hashed = await hasher.hash("12345678")
+            imported = await hasher.hash_imports(["a", "b", "c"])
+            assert await hasher.verify("12345678", hashed)
+            assert not await hasher.verify("12345678", None)
+            assert [await hasher.verify(p, h) for p, h in zip("abc", imported)] == [True] * 3
+            assert imported[0].startswith("scrypt$16$")
+        finally:
+            hasher.close()
+    asyncio.run(test())
+
+
+def test_hasher_queue_limit():
+    async def test():
+        hasher = PasswordHasher(max_workers=1, max_queue=1, import_cost=2 ** 4)
+        release = threading.Event()
+        try:
+            waiting = [asyncio.create_task(hasher._run(release.wait)) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            assert hasher.pending == 2
+            with pytest.raises(HTTPException) as error:
+                await hasher.verify("12345678", None)
+            assert error.value.status_code == 503
+            assert error.value.headers == {"Retry-After": "1"}
+            # Imports have their own threads and don't take a place
+            assert len(await hasher.hash_imports(["12345678"])) == 1
+            release.set()
+            await asyncio.gather(*waiting)
+            assert hasher.pending == 0
+            assert not await hasher.verify("12345678", None)
+        finally:
+            release.set()
+            hasher.close()
+    asyncio.run(test())
+
+# Sessions
+
+
+def test_token_round_trip_and_tamper():
+    tokens = SessionTokens("secret")
+    token = tokens.issue(7, "valeryok", "hash")
+    session = tokens.validate(token)
+    assert (session.person_id, session.username) == (7, "valeryok")
+    # Validated again without the cache
+    assert SessionTokens("secret").validate(token) == session
+    assert SessionTokens("other").validate(token) is None
+
+    payload, signature = token.split(".")
+    forged = SessionTokens("attacker").issue(8, "valeryok", "hash").split(".")[0]
+    for bad in (f"{forged}.{signature}", f"{payload}.{signature[:-2]}AA",
+                payload, "", "a.b.c"):
+        assert tokens.validate(bad) is None
+
+
+def test_token_credential():
+    tokens = SessionTokens("secret")
+    token = tokens.issue(7, "valeryok", "hash")
+    session = tokens.validate(token)
+    assert tokens.matches(token, session, {"username": "valeryok", "password": "hash"})
+    for person in ({"username": "valeryok", "password": "new hash"},
+                   {"username": "kevin", "password": "hash"}, None):
+        assert not tokens.matches(token, session, person)
+    assert token not in tokens._cache
+
+
+def test_token_expiry(monkeypatch):
+    tokens = SessionTokens("secret", ttl=10)
+    token = tokens.issue(7, "valeryok", "hash")
+    now = time.time()
+    monkeypatch.setattr("security.time.time", lambda: now + 11)
+    assert tokens.validate(token) is None
+    assert token not in tokens._cache
+    assert SessionTokens("secret").validate(token) is None
+
+
+def test_token_cache_eviction():
+    tokens = SessionTokens("secret", max_entries=2)
+    first = tokens.issue(1, "user", "hash")
+    second = tokens.issue(2, "user", "hash")
+    tokens.validate(first)
+    third = tokens.issue(3, "user", "hash")
+    assert list(tokens._cache) == [first, third]
+    # An evicted token is still valid, it is decoded again
+    assert tokens.validate(second).person_id == 2
+    assert list(tokens._cache) == [third, second]
+
+
+def test_split_token():
+    assert split_token("Bearer abc", "cookie") == "abc"
+    assert split_token("Basic abc", "cookie") == "cookie"
+    assert split_token(None, None) is None
+
+# Path operations
+
+PERSON = {"first_name": "facundo", "last_name": "cabrera", "age": 22,
+          "password": "12345678"}
+
+
+def test_update_needs_the_session_of_the_person():
+    with TestClient(main.app) as client:
+        ids = {}
+        for username in ("owner1", "other1"):
+            response = client.post("/person/new", json={**PERSON, "username": username})
+            ids[username] = int(response.headers["location"].rsplit("/", 1)[1])
+        owner = {**PERSON, "username": "owner1"}
+        url = f"/person/{ids['owner1']}"
+
+        assert client.put(url, json=owner).status_code == 401
+        client.post("/login", data={"username": "other1", "password": "12345678"})
+        assert client.put(url, json=owner).status_code == 403
+
+        token = client.post("/login", data={"username": "owner1", "password": "12345678"}) \
+            .cookies["session"]
+        bearer = {"authorization": f"Bearer {token}"}
+        # The same password keeps the session
+        assert client.put(url, json={**owner, "age": 30}, headers=bearer).status_code == 200
+        assert client.get("/login", headers=bearer).status_code == 200
+        # A new password ends it
+        response = client.put(url, json={**owner, "password": "87654321"}, headers=bearer)
+        assert response.status_code == 200
+        assert client.get("/login", headers=bearer).status_code == 401
+        assert client.put(url, json=owner, headers=bearer).status_code == 401
+        form = {"username": "owner1", "password": "87654321"}
+        assert client.post("/login", data=form).status_code == 200
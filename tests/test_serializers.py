@@ -0,0 +1,103 @@
+import itertools
+
+import pytest
+from fastapi import Body, FastAPI, Form
+from fastapi.testclient import TestClient
+
+import main
+import serializers
+
+# The same routes written the plain FastAPI way, validated again as
+# response_model and encoded by jsonable_encoder
+reference = FastAPI()
+
+
+@reference.post("/person/new", response_model=main.PersonOut, status_code=201)
+def create_person(person: main.Person = Body(...)):
+    return person
+
+
+@reference.put("/person/{person_id}", response_model=main.PersonOut)
+def update_person(person_id: int, person: main.Person = Body(...)):
+    return person
+
+
+@reference.post("/login", response_model=main.LoginOut)
+def login(username: str = Form(...), password: str = Form(...)):
+    return main.LoginOut(username=username)
+
+
+@reference.get("/persons", response_model=main.PersonPage)
+async def list_persons(limit: int = 50):
+    persons = await main.store.list(main.PersonFilter(), after=0, limit=limit + 1)
+    return {
+        "items": [person for _, person in persons[:limit]],
+        "next_cursor": persons[limit - 1][0] if len(persons) > limit else None,
+    }
+
+
+NAMES = ["facundo", 'Ñandú   "q" \\ \x01   ☃ 😀']
+
+PERSONS = [
+    {"first_name": name, "last_name": "cabrera cabrales", "age": 22,
+     "password": "12345678",
+     **({"hair_color": color} if color else {}),
+     **({"is_married": married} if married is not None else {})}
+    for color, married, name in itertools.product(
+        [None, "black", "white"], [None, True, False], NAMES)
+]
+
+
+@pytest.fixture(params=[True, False], ids=["orjson", "json"])
+def clients(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(serializers, "orjson", None)
+    elif serializers.orjson is None:
+        pytest.skip("orjson is not installed")
+    with TestClient(main.app) as client:
+        yield client, TestClient(reference), "o" if request.param else "j"
+
+
+def assert_identical(response, expected):
+    assert response.status_code == expected.status_code
+    assert response.content == expected.content
+    for header in ("content-type", "content-length"):
+        assert response.headers[header] == expected.headers[header]
+
+
+@pytest.mark.parametrize("person", PERSONS)
+def test_person_new(clients, person):
+    client, reference_client, _ = clients
+    assert_identical(client.post("/person/new", json=person),
+                     reference_client.post("/person/new", json=person))
+
+
+def test_person_update(clients):
+    client, reference_client, prefix = clients
+    username = prefix + "upd"
+    response = client.post("/person/new", json={**PERSONS[0], "username": username})
+    person_id = response.headers["location"].rsplit("/", 1)[1]
+    client.post("/login", data={"username": username, "password": "12345678"})
+    for person in PERSONS:
+        person = {**person, "username": username}
+        response = client.put(f"/person/{person_id}", json=person)
+        assert_identical(response, reference_client.put(f"/person/{person_id}", json=person))
+        assert "password" not in response.json()
+
+
+def test_login(clients):
+    client, reference_client, prefix = clients
+    for username in [prefix + "valeryok", prefix + "é😀"]:
+        client.post("/person/new", json={**PERSONS[0], "username": username})
+        form = {"username": username, "password": "12345678"}
+        assert_identical(client.post("/login", data=form),
+                         reference_client.post("/login", data=form))
+
+
+def test_persons(clients):
+    client, reference_client, _ = clients
+    for person in PERSONS:
+        client.post("/person/new", json=person)
+    for limit in (3, 500):
+        assert_identical(client.get("/persons", params={"limit": limit}),
+                         reference_client.get("/persons", params={"limit": limit}))
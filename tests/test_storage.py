@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from storage import DuplicateError, PersonFilter, create_store
+
+PERSON = {
+    "first_name": "facundo",
+    "last_name": "cabrera cabrales",
+    "age": 22,
+    "hair_color": "black",
+    "is_married": False,
+    "password": "hashed",
+    "username": None,
+}
+
+
+@pytest.fixture(params=[None, "sqlite+aiosqlite://"], ids=["memory", "sqlite"])
+def run(request):
+    """Run a coroutine against a connected store of every engine"""
+    store = create_store(request.param)
+
+    def runner(test):
+        async def main():
+            await store.connect()
+            try:
+                return await test(store)
+            finally:
+                await store.close()
+        return asyncio.run(main())
+
+    return runner
+
+
+def test_create_and_get(run):
+    async def test(store):
+        person_id = await store.create(PERSON)
+        assert await store.get(person_id) == PERSON
+        assert await store.get(person_id + 1) is None
+    run(test)
+
+
+def test_update(run):
+    async def test(store):
+        person_id = await store.create(PERSON)
+        assert await store.update(person_id, {**PERSON, "age": 30})
+        assert (await store.get(person_id))["age"] == 30
+        assert not await store.update(person_id + 1, PERSON)
+    run(test)
+
+
+def test_duplicate_username(run):
+    async def test(store):
+        first = await store.create({**PERSON, "username": "valeryok"})
+        second = await store.create({**PERSON, "username": "kevin"})
+        with pytest.raises(DuplicateError):
+            await store.create({**PERSON, "username": "valeryok"})
+        with pytest.raises(DuplicateError):
+            await store.update(second, {**PERSON, "username": "valeryok"})
+        with pytest.raises(DuplicateError):
+            await store.create_many([{**PERSON, "username": "ana"},
+                                     {**PERSON, "username": "ana"}])
+        # A person keeps its own username on update
+        assert await store.update(first, {**PERSON, "username": "valeryok", "age": 40})
+        found_id, found = await store.get_by_username("valeryok")
+        assert (found_id, found["age"]) == (first, 40)
+        assert await store.get_by_username("ana") is None
+    run(test)
+
+
+def test_other_integrity_errors_are_not_duplicates(run):
+    async def test(store):
+        if not hasattr(store, "engine"):
+            pytest.skip("the memory store has no other constraints")
+        with pytest.raises(IntegrityError):
+            await store.create({**PERSON, "first_name": None})
+    run(test)
+
+
+def test_list(run):
+    async def test(store):
+        rows = [
+            {**PERSON, "first_name": name, "age": age, "hair_color": color}
+            for name, age, color in [
+                ("maria", 20, "black"), ("mario", 35, "white"), ("ana", 40, "black"),
+                ("marta", 50, "black"), ("mar", 25, None), ("Mario", 30, "black"),
+                ("\U0010ffffa", 60, None),
+            ]
+        ]
+        await store.create_many(rows)
+        await store.update(1, {**rows[0], "hair_color": "brown"})
+
+        async def ids(filters, limit=2):
+            found, after = [], 0
+            while True:
+                page = await store.list(filters, after=after, limit=limit)
+                if not page:
+                    return found
+                found += [person_id for person_id, _ in page]
+                after = page[-1][0]
+
+        assert await ids(PersonFilter()) == [1, 2, 3, 4, 5, 6, 7]
+        assert await ids(PersonFilter(hair_color="black")) == [3, 4, 6]
+        assert await ids(PersonFilter(age_min=25, age_max=40)) == [2, 3, 5, 6]
+        assert await ids(PersonFilter(name_prefix="mar")) == [1, 2, 4, 5]
+        assert await ids(PersonFilter(name_prefix="mar", age_min=30)) == [2, 4]
+        assert await ids(PersonFilter(name_prefix="\U0010ffff")) == [7]
+    run(test)
+
+
+def test_iter(run):
+    async def test(store):
+        names = ["maria", "ana", "mario", "marta", "ana", "mar"] * 10
+        await store.create_many([{**PERSON, "first_name": name, "age": age,
+                                  "hair_color": "black" if age % 2 else "white"}
+                                 for age, name in enumerate(names, 1)])
+        # A renamed person leaves the prefix range of the old name
+        await store.update(1, {**PERSON, "first_name": "bruno", "age": 1})
+
+        async def ids(filters, **options):
+            return [person_id async for person_id, _ in store.iter(filters, **options)]
+
+        for filters in (PersonFilter(), PersonFilter(name_prefix="mar"),
+                        PersonFilter(name_prefix="mar", age_min=10, age_max=40),
+                        PersonFilter(name_prefix="b"), PersonFilter(hair_color="white")):
+            expected = [person_id for person_id, _ in
+                        await store.list(filters, limit=len(names))]
+            assert await ids(filters, page_size=7) == expected
+        assert await ids(PersonFilter(name_prefix="b")) == [1]
+
+        # Persons changed during the iteration don't make it skip others
+        found = []
+        async for person_id, _ in store.iter(PersonFilter(hair_color="black"), page_size=7):
+            found.append(person_id)
+            if person_id == 11:
+                for changed in (5, 21):
+                    await store.update(changed, {**PERSON, "hair_color": "white"})
+        assert found == [person_id for person_id in range(1, len(names) + 1, 2)
+                         if person_id != 21]
+    run(test)